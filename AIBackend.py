@@ -0,0 +1,222 @@
+# AIBackend.py
+#  Where the qk editors send their chat completions.  Every editor takes --backend, or QK_BACKEND:
+#      openai                 the OpenAI API, or whatever OPENAI_BASE_URL points at
+#      stub[:latency[:tps]]   an AIStubServer started inside the editor, no network and no key needed
+#      record:<file>          the OpenAI API, with each request, reply and its timing appended to <file>
+#      replay:<file>          replies read back from a recording, paced as they were recorded
+#      instant:<file>         replies read back from a recording, without waiting
+#  A backend has complete(model, max_tokens, messages), returning something shaped like a chat completion,
+#  and stream(model, max_tokens, messages), a generator of text deltas; close it to stop the reply early.
+#  Record a session once, then replay it for timing runs that neither vary nor need the network:
+#      python AIBackend.py --backend record:bench.jsonl --requests 20 --workers 4 --stream
+#      python AIBackend.py --backend replay:bench.jsonl --requests 20 --workers 4 --stream
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from collections import deque
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from openai import OpenAI
+except ImportError:
+    OpenAI = None
+
+class CogReply:
+    # Shaped like a chat completion, so streamed replies feed apply_textops just as a live reply does.
+    def __init__(self, content):
+        self.choices = [SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))]
+
+def fingerprint(model, max_tokens, messages):
+    return hashlib.sha256(json.dumps([model, max_tokens, messages], sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+class OpenAIBackend:
+    # The client is made on first use, so an editor replaying a recording needs no key.
+    def __init__(self, base_url=None, api_key=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.client = None
+        self.lock = threading.Lock()
+    def get_client(self):
+        with self.lock:
+            if self.client is None:
+                if OpenAI is None:
+                    raise RuntimeError("the openai package is not installed; use a replay:<file> backend")
+                self.client = OpenAI(api_key=self.api_key or os.environ.get("CUSTOM_ENV_NAME"), base_url=self.base_url)
+            return self.client
+    def complete(self, model, max_tokens, messages):
+        return self.get_client().chat.completions.create(
+            model = model,
+            max_tokens = max_tokens,
+            messages = messages
+        )
+    def stream(self, model, max_tokens, messages):
+        stream = self.get_client().chat.completions.create(
+            model = model,
+            max_tokens = max_tokens,
+            messages = messages,
+            stream = True
+        )
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            stream.close()
+    def describe(self):
+        return self.base_url or os.environ.get("OPENAI_BASE_URL") or "openai"
+
+class StubBackend(OpenAIBackend):
+    def __init__(self, latency=0.25, tokens_per_sec=50.0):
+        from AIStubServer import StubServer
+        self.server = StubServer(0, latency, tokens_per_sec)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        super().__init__(f"http://127.0.0.1:{self.server.server_address[1]}/v1", "stub")
+    def describe(self):
+        return f"stub {self.server.latency}s {self.server.tokens_per_sec} tokens/s"
+
+class RecordBackend:
+    # Passes requests on to backend and appends one JSON line per finished reply: the request, its
+    # fingerprint, the reply, seconds to the first token and in all, and for streams each delta's offset.
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+    def record(self, model, max_tokens, messages, content, ttft, seconds, deltas=None):
+        entry = {
+            "key": fingerprint(model, max_tokens, messages),
+            "stream": deltas is not None,
+            "model": model,
+            "max_tokens": max_tokens,
+            "messages": messages,
+            "content": content,
+            "ttft": round(ttft, 4),
+            "seconds": round(seconds, 4),
+            "deltas": deltas
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+    def complete(self, model, max_tokens, messages):
+        started = time.monotonic()
+        completion = self.backend.complete(model, max_tokens, messages)
+        seconds = time.monotonic() - started
+        self.record(model, max_tokens, messages, completion.choices[0].message.content, seconds, seconds)
+        return completion
+    def stream(self, model, max_tokens, messages):
+        started = time.monotonic()
+        deltas = []
+        for delta in self.backend.stream(model, max_tokens, messages):
+            deltas.append([round(time.monotonic() - started, 4), delta])
+            yield delta
+        seconds = time.monotonic() - started
+        self.record(model, max_tokens, messages, "".join(delta for _, delta in deltas), deltas[0][0] if deltas else seconds, seconds, deltas)
+    def describe(self):
+        return f"{self.backend.describe()}, recording to {self.path}"
+
+class ReplayBackend:
+    # Answers from a recording by request fingerprint, preferring replies recorded the same way, streamed
+    # or whole.  A request made more than once gets its replies in recorded order, the last one repeating.
+    # speed scales the recorded waits; 0 skips them.
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.replies = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.replies.setdefault((entry["key"], entry.get("stream", False)), deque()).append(entry)
+    def lookup(self, model, max_tokens, messages, stream):
+        key = fingerprint(model, max_tokens, messages)
+        with self.lock:
+            entries = self.replies.get((key, stream)) or self.replies.get((key, not stream))
+            if not entries:
+                raise LookupError(f"no recorded reply in {self.path} for this {model} request")
+            return entries.popleft() if len(entries) > 1 else entries[0]
+    def wait_until(self, started, offset):
+        delay = started + offset * self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    def complete(self, model, max_tokens, messages):
+        started = time.monotonic()
+        entry = self.lookup(model, max_tokens, messages, False)
+        self.wait_until(started, entry["seconds"])
+        return CogReply(entry["content"])
+    def stream(self, model, max_tokens, messages):
+        started = time.monotonic()
+        entry = self.lookup(model, max_tokens, messages, True)
+        for offset, delta in entry["deltas"] or [[entry["ttft"], entry["content"]]]:
+            self.wait_until(started, offset)
+            yield delta
+        self.wait_until(started, entry["seconds"])
+    def describe(self):
+        return f"replay {self.path}" + (f" x{self.speed}" if self.speed != 1.0 else "")
+
+def open_backend(spec=None):
+    spec = spec or os.environ.get("QK_BACKEND") or "openai"
+    kind, _, rest = spec.partition(':')
+    if kind == "openai":
+        return OpenAIBackend(rest or None)
+    if kind == "stub":
+        return StubBackend(*(float(value) for value in rest.split(':') if value))
+    if kind == "record" and rest:
+        return RecordBackend(rest, OpenAIBackend())
+    if kind == "replay" and rest:
+        return ReplayBackend(rest)
+    if kind == "instant" and rest:
+        return ReplayBackend(rest, speed=0.0)
+    raise ValueError(f"unknown AI backend {spec!r}; expected openai, stub[:latency[:tps]], record:<file>, replay:<file> or instant:<file>")
+
+def add_backend_argument(parser):
+    parser.add_argument('--backend', default=None, help='openai, stub[:latency[:tps]], record:<file>, replay:<file> or instant:<file>; defaults to $QK_BACKEND, then openai')
+
+def bench(backend, requests, workers, stream, model, max_tokens, prompt):
+    # The same numbered prompts every run, so a recording of one run replays for the next.
+    def run(i):
+        messages = [{"role": "user", "content": f"{i}: {prompt}"}]
+        started = time.monotonic()
+        ttft = None
+        if stream:
+            content = []
+            for delta in backend.stream(model, max_tokens, messages):
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                content.append(delta)
+            content = "".join(content)
+        else:
+            content = backend.complete(model, max_tokens, messages).choices[0].message.content
+        seconds = time.monotonic() - started
+        return ttft if ttft is not None else seconds, seconds, len(content)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, range(requests)))
+    elapsed = time.monotonic() - started
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+    ttfts = [ttft for ttft, _, _ in results]
+    totals = [seconds for _, seconds, _ in results]
+    chars = sum(size for _, _, size in results)
+    print(f"{backend.describe()}  {requests} requests, {workers} workers, {'streamed' if stream else 'whole'}")
+    print(f"first token  p50 {percentile(ttfts, 0.5):.3f}s  p95 {percentile(ttfts, 0.95):.3f}s")
+    print(f"whole reply  p50 {percentile(totals, 0.5):.3f}s  p95 {percentile(totals, 0.95):.3f}s")
+    print(f"throughput   {requests / elapsed:.2f} requests/s  {chars / elapsed:.0f} chars/s  in {elapsed:.3f}s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_backend_argument(parser)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--model', default='gpt-4o-mini')
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--prompt', default="Correct the spelling: The fluffy unicorn, with ligth green spots, naïvely pasted this.")
+    args = parser.parse_args()
+    bench(open_backend(args.backend), args.requests, args.workers, args.stream, args.model, args.max_tokens, args.prompt)
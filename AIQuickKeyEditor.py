@@ -7,24 +7,1220 @@
 #This work is copyright. All rights reserved.
 
 import os
+import sys
 import re
+import io
+import ast
+import copy
 import json
+import mmap
+import zlib
+import difflib
+import bisect
+import tokenize
+import textwrap
+import sqlite3
 import argparse
 import curses
 import signal
+import atexit
 import subprocess
-from openai import OpenAI
+import time
+import queue
+import tempfile
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+from array import array
+from operator import itemgetter
+from collections.abc import Sequence, MutableSequence
+from AIBackend import CogReply, fingerprint, open_backend, add_backend_argument
+from QuickSpellIndex import SpellIndex
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 parser = argparse.ArgumentParser()
 parser.add_argument('session', nargs='?', default="quickAi.txt")
+parser.add_argument('--render-stats', action='store_true')
+parser.add_argument('--cache', default=os.path.expanduser('~/.qk_response_cache.db'))
+parser.add_argument('--compact', action='store_true')
+parser.add_argument('--rev', type=int, default=None, help='write revision N of the session out of its .qkrev store and exit')
+parser.add_argument('--out', default=None, help='where --rev writes the revision; defaults to <session>.<N><suffix>')
+parser.add_argument('--sync-interval', type=float, default=1.0)
+parser.add_argument('--ai-workers', type=int, default=3)
+parser.add_argument('--words', default=None, help='word list, or its .qksi index, for the Spelling viewpoint to check locally first')
+parser.add_argument('--subrev-cache', type=int, default=64, help='subrevisions kept in memory; older ones reload from the .qkrev store')
+parser.add_argument('--mmap-threshold', type=int, default=32, help='open files of at least this many MB through mmap')
+parser.add_argument('--bench', choices=['save', 'keys', 'extract', 'refactor'], default=None, help='run a timing benchmark and exit; save runs in a scratch directory')
+add_backend_argument(parser)
 args = parser.parse_args()
-client = OpenAI(api_key=os.environ.get("CUSTOM_ENV_NAME"))
+backend = open_backend(args.backend)
+
+class BackgroundWriter:
+    # One thread owns every file the editor writes.  Appends go to handles that stay open, queued
+    # writes are taken in batches, and dirty files are fsynced every sync_interval seconds or at a
+    # save point.  flush() waits until everything queued so far is on disk.  Failures land in error
+    # for the status line; a writer thread that has died is reported there too rather than waited on.
+    # Appended data may be a callable, so costly encoding runs here rather than on the UI thread,
+    # and call() runs a function once everything queued before it can be read back from disk.
+    FLUSH_POLL = 0.5
+    def __init__(self, sync_interval=1.0):
+        self.sync_interval = sync_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.handles = {}
+        self.dirty = set()
+        self.error = None
+        self.last_sync = time.monotonic()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    def submit(self, op, path, data):
+        with self.lock:
+            self.pending[path] = self.pending.get(path, 0) + 1
+        self.queue.put((op, path, data))
+    def append(self, path, data):
+        self.submit('append', path, data)
+    def replace(self, path, data):
+        self.submit('replace', path, data)
+    def release(self, path):
+        self.submit('release', path, None)
+    def save_point(self):
+        self.queue.put(('sync', None, None))
+    def call(self, function):
+        self.queue.put(('call', None, function))
+    def flush(self, sync=False):
+        done = threading.Event()
+        self.queue.put(('flush', sync, done))
+        while not done.wait(self.FLUSH_POLL):
+            if not self.thread.is_alive():
+                self.error = self.error or RuntimeError("background writer stopped")
+                return
+    def wait_for(self, path):
+        if self.pending.get(path):
+            self.flush()
+    def take_error(self):
+        # The failure since the last call, for the status line, and clears it so the next save
+        # tries again.  A writer thread that has died is started again on the same queue.
+        error, self.error = self.error, None
+        if not self.thread.is_alive():
+            error = error or RuntimeError("background writer stopped")
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+        return error
+    def work(self):
+        while True:
+            timeout = max(0.0, self.sync_interval - (time.monotonic() - self.last_sync)) if self.dirty else None
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                self.sync()
+                continue
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiting = [data for op, path, data in batch if op == 'flush']
+            try:
+                sync = False
+                for op, path, data in batch:
+                    if op == 'flush':
+                        sync = sync or path
+                    elif op == 'sync':
+                        sync = True
+                    elif op == 'call':
+                        self.flush_handles()
+                        try:
+                            data()
+                        except Exception as e:
+                            self.error = e
+                    else:
+                        self.write(op, path, data)
+                self.flush_handles()
+                if sync or time.monotonic() - self.last_sync >= self.sync_interval:
+                    self.sync()
+            finally:
+                for done in waiting:
+                    done.set()
+    def flush_handles(self):
+        for handle in self.handles.values():
+            try:
+                handle.flush()
+            except OSError as e:
+                self.error = e
+    def write(self, op, path, data):
+        try:
+            if callable(data):
+                try:
+                    data = data()
+                except Exception as e:
+                    # A deferred encoding that fails drops its write; the writer carries on.
+                    self.error = e
+                    return
+            if isinstance(data, str):
+                data = data.encode()
+            if op == 'append':
+                if path not in self.handles:
+                    self.handles[path] = open(path, 'ab')
+                self.handles[path].write(data)
+                self.dirty.add(path)
+                return
+            handle = self.handles.pop(path, None)
+            if handle:
+                if path in self.dirty:
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                    self.dirty.discard(path)
+                handle.close()
+            if op == 'replace':
+                with open(path + '.qktmp', 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + '.qktmp', path)
+        except OSError as e:
+            self.error = e
+        finally:
+            with self.lock:
+                self.pending[path] -= 1
+    def sync(self):
+        for path in list(self.dirty):
+            try:
+                os.fsync(self.handles[path].fileno())
+            except (OSError, KeyError) as e:
+                self.error = e
+        self.dirty.clear()
+        self.last_sync = time.monotonic()
+    def close(self):
+        self.flush(sync=True)
+
+writer = BackgroundWriter(args.sync_interval)
+
+class RopeLeaf:
+    __slots__ = ('lines', 'count', 'owner')
+    def __init__(self, lines):
+        self.lines = lines
+        self.count = len(lines)
+        self.owner = None
+
+class RopeNode:
+    __slots__ = ('children', 'count', 'owner')
+    def __init__(self, children):
+        self.children = children
+        self.count = sum(child.count for child in children)
+        self.owner = None
+
+class MappedLines(MutableSequence):
+    # The lines of one block of a memory-mapped file.  Line offsets are found the first time the
+    # block is read and each line is decoded when it is asked for; the first edit copies the block
+    # into a plain list, so edits never touch the file and untouched blocks cost only their offsets.
+    __slots__ = ('mm', 'start', 'stop', 'count', 'offsets', 'lines')
+    def __init__(self, mm, start, stop, count):
+        self.mm = mm
+        self.start = start
+        self.stop = stop
+        self.count = count
+        self.offsets = None
+        self.lines = None
+    def __len__(self):
+        return self.count if self.lines is None else len(self.lines)
+    def line_offsets(self):
+        if self.offsets is None:
+            block = self.mm[self.start:self.stop]
+            ends = [match.end() for match in re.finditer(b'\n', block)]
+            if not ends or ends[-1] != len(block):
+                ends.append(len(block))
+            self.offsets = array('I', [0] + ends)
+        return self.offsets
+    def __getitem__(self, index):
+        if self.lines is not None:
+            return self.lines[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('line index out of range')
+        offsets = self.line_offsets()
+        line = self.mm[self.start + offsets[index]:self.start + offsets[index + 1]]
+        if line.endswith(b'\n'):
+            line = line[:-2] if line.endswith(b'\r\n') else line[:-1]
+        return line.decode('utf-8', errors='replace')
+    def __iter__(self):
+        # A full pass (saving, a snapshot, a patch) decodes the block in one go, not line by line.
+        if self.lines is not None:
+            return iter(self.lines)
+        block = self.mm[self.start:self.stop]
+        lines = block.decode('utf-8', errors='replace').split('\n')
+        if block.endswith(b'\n'):
+            lines.pop()
+        if b'\r\n' in block:
+            lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+        return iter(lines)
+    def materialize(self):
+        if self.lines is None:
+            self.lines = list(self)
+            self.offsets = None
+        return self.lines
+    def __setitem__(self, index, line):
+        self.materialize()[index] = line
+    def __delitem__(self, index):
+        del self.materialize()[index]
+    def insert(self, index, line):
+        self.materialize().insert(index, line)
+
+class MappedFile:
+    # A large file opened read-only through mmap and cut into blocks of about BLOCK_SIZE bytes that
+    # end on a newline.  The blocks for the first screen are cut at once; a thread cuts the rest and
+    # queues them for the LineBuffer, which grafts them on when the main loop polls.
+    BLOCK_SIZE = 1 << 16
+    BATCH = 256
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.mm)
+        self.position = 0
+        self.ready = queue.Queue()
+    def cut(self):
+        start = self.position
+        stop = self.size
+        if start + self.BLOCK_SIZE < self.size:
+            newline = self.mm.find(b'\n', start + self.BLOCK_SIZE - 1)
+            if newline >= 0:
+                stop = newline + 1
+        count = self.mm[start:stop].count(b'\n') + (self.mm[stop - 1] != ord('\n'))
+        self.position = stop
+        return RopeLeaf(MappedLines(self.mm, start, stop, count))
+    def first_blocks(self, line_count):
+        leaves = []
+        while self.position < self.size and sum(leaf.count for leaf in leaves) < line_count:
+            leaves.append(self.cut())
+        return leaves
+    def start(self):
+        threading.Thread(target=self.work, daemon=True).start()
+    def work(self):
+        leaves = []
+        while self.position < self.size:
+            leaves.append(self.cut())
+            if len(leaves) == self.BATCH:
+                self.ready.put(leaves)
+                leaves = []
+                time.sleep(0)
+        self.ready.put(leaves)
+        self.ready.put(None)
+    def take(self, wait=False):
+        leaves = []
+        while True:
+            try:
+                batch = self.ready.get(block=wait)
+            except queue.Empty:
+                return leaves, False
+            if batch is None:
+                return leaves, True
+            leaves.extend(batch)
+
+class RopeView(Sequence):
+    # Reading a rope: the line count is kept at the root and a line is one root-to-leaf walk away.
+    def __len__(self):
+        return self.root.count
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        leaf, offset = self.locate(index)
+        return leaf.lines[offset]
+    def __iter__(self):
+        for leaf in self.leaves():
+            yield from leaf.lines
+    def leaves(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, RopeLeaf):
+                yield node
+            else:
+                stack.extend(reversed(node.children))
+    def locate(self, index):
+        if index < 0:
+            index += self.root.count
+        if not 0 <= index < self.root.count:
+            raise IndexError('line index out of range')
+        node = self.root
+        while isinstance(node, RopeNode):
+            for child in node.children:
+                if index < child.count:
+                    node = child
+                    break
+                index -= child.count
+        return node, index
+
+class LineSnapshot(RopeView):
+    # The lines of a LineBuffer at one moment, taken in O(1).  The snapshot shares every node with
+    # the buffer and with earlier snapshots; the buffer copies a node before it next changes it, so
+    # a revision costs only the paths edited since the one before.
+    __slots__ = ('root',)
+    def __init__(self, root):
+        self.root = root
+    @staticmethod
+    def of(lines):
+        if isinstance(lines, LineSnapshot):
+            return lines
+        if not isinstance(lines, LineBuffer):
+            lines = LineBuffer(lines)
+        return lines.snapshot()
+
+class LineBuffer(RopeView, MutableSequence):
+    # A rope of line chunks: leaves hold up to LEAF_SIZE lines and inner nodes keep line counts,
+    # so finding, inserting, deleting and splitting a line only walks one root-to-leaf path.
+    # Nodes stamped with the buffer's current owner token are edited in place; any other node may be
+    # shared with a snapshot and is copied first.  While a mapped file is still loading, len() counts
+    # only the lines grafted so far; iterating and snapshot(), and so saving, wait for the rest.
+    LEAF_SIZE = 64
+    FANOUT = 32
+    def __init__(self, lines=()):
+        self.token = object()
+        self.root = lines.root if isinstance(lines, LineSnapshot) else self.build(list(lines))
+        self.listeners = []
+        self.loader = None
+        self.grafting = False
+    @classmethod
+    def mapped(cls, path, first_lines=256):
+        # Open a large file lazily: the first blocks now, the rest as load_more() is polled.
+        buffer = cls()
+        buffer.loader = MappedFile(path)
+        buffer.root = buffer.graft(buffer.loader.first_blocks(first_lines))
+        buffer.loader.start()
+        return buffer
+    def load_more(self, wait=False):
+        # Graft on the blocks the loader has cut so far; True while more are coming.
+        if self.loader is None:
+            return False
+        leaves, done = self.loader.take(wait)
+        if leaves:
+            start = self.root.count
+            self.append_leaves(leaves)
+            if self.listeners:
+                self.grafting = True
+                try:
+                    self.changed(start, [], self.root.count - start)
+                finally:
+                    self.grafting = False
+        if done:
+            self.loader = None
+        return self.loader is not None
+    @property
+    def loading(self):
+        return self.loader is not None
+    def append_leaves(self, leaves):
+        # Adds whole leaves after the last line, copying only the right edge of the tree.
+        root = self.writable_root()
+        for leaf in leaves:
+            if leaf.count:
+                sibling = self.append_at(root, leaf)
+                if sibling is not None:
+                    root = self.root = self.own(RopeNode([root, sibling]))
+    def append_at(self, node, leaf):
+        node.count += leaf.count
+        children = node.children
+        if isinstance(children[-1], RopeLeaf):
+            if children[-1].count:
+                children.append(leaf)
+            else:
+                children[-1] = leaf
+        else:
+            child = children[-1] = self.writable(children[-1])
+            sibling = self.append_at(child, leaf)
+            if sibling is not None:
+                children.append(sibling)
+        if len(children) > 2 * self.FANOUT:
+            tail = self.own(RopeNode(children[self.FANOUT:]))
+            del children[self.FANOUT:]
+            node.count -= tail.count
+            return tail
+        return None
+    def changed(self, start, old_lines, new_count):
+        for listener in self.listeners:
+            listener(start, old_lines, new_count)
+    def build(self, lines):
+        return self.graft([self.own(RopeLeaf(lines[i:i + self.LEAF_SIZE])) for i in range(0, len(lines), self.LEAF_SIZE)])
+    def graft(self, leaves):
+        nodes = leaves or [self.own(RopeLeaf([]))]
+        while len(nodes) > self.FANOUT:
+            nodes = [self.own(RopeNode(nodes[i:i + self.FANOUT])) for i in range(0, len(nodes), self.FANOUT)]
+        return self.own(RopeNode(nodes))
+    def own(self, node):
+        node.owner = self.token
+        return node
+    def writable(self, node):
+        if node.owner is self.token:
+            return node
+        if isinstance(node, RopeLeaf):
+            return self.own(RopeLeaf(list(node.lines)))
+        return self.own(RopeNode(list(node.children)))
+    def snapshot(self):
+        self.load_more(wait=True)
+        self.token = object()
+        return LineSnapshot(self.root)
+    def __iter__(self):
+        self.load_more(wait=True)
+        return super().__iter__()
+    def locate_writable(self, index):
+        node = self.root = self.writable(self.root)
+        while isinstance(node, RopeNode):
+            children = node.children
+            for idx, child in enumerate(children):
+                if index < child.count:
+                    break
+                index -= child.count
+            node = children[idx] = self.writable(child)
+        return node, index
+    def __setitem__(self, index, line):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('extended slices are not supported')
+            self.replace_lines(start, stop, line)
+            return
+        if index < 0:
+            index += self.root.count
+        if not 0 <= index < self.root.count:
+            raise IndexError('line index out of range')
+        leaf, offset = self.locate_writable(index)
+        old_line = leaf.lines[offset]
+        leaf.lines[offset] = line
+        if self.listeners:
+            self.changed(index % self.root.count, [old_line], 1)
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('extended slices are not supported')
+            old_lines = [self.delete_at(self.writable_root(), start) for _ in range(max(0, stop - start))]
+            self.collapse_root()
+            if old_lines and self.listeners:
+                self.changed(start, old_lines, 0)
+            return
+        if index < 0:
+            index += self.root.count
+        if not 0 <= index < self.root.count:
+            raise IndexError('line index out of range')
+        old_line = self.delete_at(self.writable_root(), index)
+        self.collapse_root()
+        if self.listeners:
+            self.changed(index, [old_line], 0)
+    def insert(self, index, line):
+        if index < 0:
+            index = max(0, index + self.root.count)
+        index = min(index, self.root.count)
+        sibling = self.insert_at(self.writable_root(), index, line)
+        if sibling is not None:
+            self.root = self.own(RopeNode([self.root, sibling]))
+        if self.listeners:
+            self.changed(index, [], 1)
+    def writable_root(self):
+        self.root = self.writable(self.root)
+        return self.root
+    def insert_at(self, node, index, line):
+        node.count += 1
+        if isinstance(node, RopeLeaf):
+            node.lines.insert(index, line)
+            if node.count > 2 * self.LEAF_SIZE:
+                tail = self.own(RopeLeaf(node.lines[self.LEAF_SIZE:]))
+                del node.lines[self.LEAF_SIZE:]
+                node.count = len(node.lines)
+                return tail
+            return None
+        children = node.children
+        for idx, child in enumerate(children):
+            if index <= child.count or idx == len(children) - 1:
+                break
+            index -= child.count
+        child = children[idx] = self.writable(child)
+        sibling = self.insert_at(child, index, line)
+        if sibling is not None:
+            children.insert(idx + 1, sibling)
+            if len(children) > 2 * self.FANOUT:
+                tail = self.own(RopeNode(children[self.FANOUT:]))
+                del children[self.FANOUT:]
+                node.count -= tail.count
+                return tail
+        return None
+    def delete_at(self, node, index):
+        node.count -= 1
+        if isinstance(node, RopeLeaf):
+            return node.lines.pop(index)
+        children = node.children
+        for idx, child in enumerate(children):
+            if index < child.count:
+                break
+            index -= child.count
+        child = children[idx] = self.writable(child)
+        line = self.delete_at(child, index)
+        if child.count == 0 and len(children) > 1:
+            children.pop(idx)
+        return line
+    def collapse_root(self):
+        while isinstance(self.root, RopeNode) and len(self.root.children) == 1 and isinstance(self.root.children[0], RopeNode):
+            self.root = self.root.children[0]
+    def pop(self, index=-1):
+        line = self[index]
+        del self[index]
+        return line
+    def clear(self):
+        old_lines = list(self) if self.listeners else []
+        self.root = self.build([])
+        if old_lines:
+            self.changed(0, old_lines, 0)
+    def extend(self, lines):
+        self.insert_lines(len(self), lines)
+    def insert_lines(self, index, lines):
+        for line in lines:
+            self.insert(index, line)
+            index += 1
+        return index
+    def replace_lines(self, start, stop, lines):
+        del self[start:stop]
+        return self.insert_lines(start, lines)
+    def insert_text(self, line_num, col_num, text):
+        line = self[line_num]
+        pieces = text.split('\n')
+        if len(pieces) == 1:
+            self[line_num] = line[:col_num] + text + line[col_num:]
+            return line_num, col_num + len(text)
+        tail = line[col_num:]
+        self[line_num] = line[:col_num] + pieces[0]
+        self.insert_lines(line_num + 1, pieces[1:-1] + [pieces[-1] + tail])
+        return line_num + len(pieces) - 1, len(pieces[-1])
+    def split_line(self, line_num, col_num):
+        line = self[line_num]
+        self[line_num] = line[:col_num]
+        self.insert(line_num + 1, line[col_num:])
+    def join_lines(self, line_num):
+        self[line_num] += self.pop(line_num + 1)
+    def delete_char(self, line_num, col_num):
+        line = self[line_num]
+        if col_num < len(line):
+            self[line_num] = line[:col_num] + line[col_num + 1:]
+        elif line_num < len(self) - 1:
+            self.join_lines(line_num)
+    def backspace(self, line_num, col_num):
+        if col_num > 0:
+            line = self[line_num]
+            self[line_num] = line[:col_num - 1] + line[col_num:]
+            return line_num, col_num - 1
+        if line_num > 0:
+            col_num = len(self[line_num - 1])
+            self.join_lines(line_num - 1)
+            return line_num - 1, col_num
+        return line_num, col_num
+
+class SymbolIndex:
+    # Header lines of every def and class in a buffer, kept sorted by line.  The headers are found on
+    # the first lookup; after that buffer edits shift the headers below them and rescan only the
+    # touched lines, and the Class::function keys are rebuilt when a header appears, disappears or
+    # is renamed.
+    header_pattern = re.compile(r'^(\s*)(?:async\s+)?(def|class)\s+(\w+)')
+    def __init__(self, buffer):
+        self.buffer = None
+        self.attach(buffer)
+    def attach(self, buffer):
+        if self.buffer is not None and self.lines_changed in self.buffer.listeners:
+            self.buffer.listeners.remove(self.lines_changed)
+        self.buffer = buffer
+        buffer.listeners.append(self.lines_changed)
+        self.headers = None
+        self.by_key = None
+    def parse_header(self, line_num, line):
+        match = self.header_pattern.match(line)
+        if match:
+            return [line_num, len(match.group(1)), match.group(2), match.group(3)]
+        return None
+    def lines_changed(self, start, old_lines, new_count):
+        if self.headers is None:
+            return
+        first = bisect.bisect_left(self.headers, start, key=itemgetter(0))
+        last = bisect.bisect_left(self.headers, start + len(old_lines), key=itemgetter(0))
+        delta = new_count - len(old_lines)
+        if delta:
+            for header in self.headers[last:]:
+                header[0] += delta
+        added = [header for header in (self.parse_header(line_num, self.buffer[line_num]) for line_num in range(start, start + new_count)) if header]
+        removed = self.headers[first:last]
+        if removed or added:
+            self.headers[first:last] = added
+            if [header[1:] for header in removed] != [header[1:] for header in added]:
+                self.by_key = None
+    def keys(self):
+        if self.headers is None:
+            self.headers = [header for header in (self.parse_header(line_num, line) for line_num, line in enumerate(self.buffer)) if header]
+        if self.by_key is None:
+            self.by_key = {}
+            self.by_name = {}
+            classes = []
+            for header in self.headers:
+                line_num, indent, kind, name = header
+                while classes and classes[-1][1] >= indent:
+                    classes.pop()
+                if kind == 'class':
+                    classes.append((name, indent))
+                    continue
+                self.by_key.setdefault(f"{classes[-1][0] if classes else None}::{name}", header)
+                self.by_name.setdefault(name, header)
+        return self.by_key
+    def lookup(self, object_name, func_name):
+        header = self.keys().get(f"{object_name}::{func_name}")
+        if header is None and object_name is None:
+            header = self.by_name.get(func_name)
+        if header is None:
+            return None
+        line_num, indent = header[0], header[1]
+        start = line_num
+        while start > 0 and self.buffer[start - 1].lstrip().startswith('@'):
+            start -= 1
+        end = len(self.buffer)
+        for following in self.headers[bisect.bisect_right(self.headers, line_num, key=itemgetter(0)):]:
+            if following[1] <= indent:
+                end = following[0]
+                while end - 1 > line_num and self.buffer[end - 1].lstrip().startswith('@'):
+                    end -= 1
+                break
+        while end - 1 > line_num and not self.buffer[end - 1].strip():
+            end -= 1
+        return start, end, ' ' * indent
+
+class ContextPacker:
+    # Packs a Python buffer for the Coder viewpoint: an ast outline of the module with whole bodies
+    # only for the functions the request is about, those named in the command window, the one under
+    # the cursor and the ones edited recently.  Classes holding one of those keep every method
+    # signature, a class named in the command window is sent whole, and the other classes shrink
+    # to their header and a list of method names.  Edited lines come from the buffer listeners.
+    RECENT_EDITS = 16
+    identifier_pattern = re.compile(r'[A-Za-z_]\w*')
+    def __init__(self, buffer):
+        self.buffer = None
+        self.attach(buffer)
+    def attach(self, buffer):
+        if self.buffer is not None and self.lines_changed in self.buffer.listeners:
+            self.buffer.listeners.remove(self.lines_changed)
+        self.buffer = buffer
+        buffer.listeners.append(self.lines_changed)
+        self.recent = []
+    def lines_changed(self, start, old_lines, new_count):
+        if self.buffer.grafting:
+            return
+        stop = start + len(old_lines)
+        delta = new_count - len(old_lines)
+        recent = [line + delta if line >= stop else line for line in self.recent if line >= stop or line < start]
+        recent.append(start)
+        self.recent = recent[-self.RECENT_EDITS:]
+    def pack(self, lines, command_lines, cursor, budget, model):
+        lines = list(lines)
+        try:
+            tree = ast.parse('\n'.join(lines))
+        except SyntaxError:
+            return None
+        wanted = set(self.identifier_pattern.findall('\n'.join(command_lines)))
+        focus = set(self.recent) | {cursor}
+        packed = []
+        functions = [0, 0]
+        self.outline(tree.body, lines, wanted, focus, False, packed, functions)
+        text = ''.join(line + '\n' for line in packed if line.strip())
+        full = ''.join(line + '\n' for line in lines if line.strip())
+        return SimpleNamespace(text=text, tokens=budget.count(text, model), full_tokens=budget.count(full, model), bodies=functions[0], functions=functions[1])
+    def outline(self, nodes, lines, wanted, focus, whole, packed, functions):
+        for node in nodes:
+            start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])]) - 1
+            end = node.end_lineno
+            near = any(start <= line < end for line in focus)
+            body_start = node.body[0].lineno - 1 if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) else end
+            if isinstance(node, ast.ClassDef) and body_start >= node.lineno:
+                methods = [child.name for child in node.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))]
+                if whole or near or node.name in wanted or wanted.intersection(methods):
+                    packed.extend(lines[start:body_start])
+                    self.outline(node.body, lines, wanted, focus, whole or node.name in wanted, packed, functions)
+                else:
+                    functions[1] += len(methods)
+                    packed.extend(lines[start:node.lineno])
+                    packed.append(f"{self.indent_of(lines[body_start])}...  # {', '.join(methods)}")
+                continue
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                functions[1] += 1
+                if whole or near or node.name in wanted or body_start < node.lineno:
+                    functions[0] += 1
+                    packed.extend(lines[start:end])
+                else:
+                    packed.extend(lines[start:body_start])
+                    packed.append(self.indent_of(lines[body_start]) + '...')
+                continue
+            if whole or near or end - start <= 3:
+                packed.extend(lines[start:end])
+            else:
+                packed.append(lines[start])
+                packed.append(self.indent_of(lines[start + 1]) + '...')
+    def indent_of(self, line):
+        return line[:len(line) - len(line.lstrip())]
+
+class UndoLog:
+    # Undo and redo for one window.  The buffer listeners record each edit as the lines it replaced
+    # and the lines it put in, so undoing a one line change costs one line whatever the file size.
+    # Edits made inside unit() undo together, and 'type' units keep absorbing typing that follows
+    # within MERGE_SECONDS.  A buffer swapped in whole is recorded as both buffers, not copied.  The
+    # oldest units are forgotten once the log holds more than MAX_LINES lines or MAX_UNITS units.
+    MAX_LINES = 200000
+    MAX_UNITS = 1000
+    MERGE_SECONDS = 1.0
+    def __init__(self, buffer, cursor, swap):
+        self.cursor = cursor
+        self.swap = swap
+        self.buffer = None
+        self.pending = None
+        self.current = None
+        self.replaying = False
+        self.reset()
+        self.attach(buffer)
+    def reset(self):
+        self.undo_units = []
+        self.redo_units = []
+        self.lines = 0
+    def attach(self, buffer):
+        if self.buffer is not None and self.lines_changed in self.buffer.listeners:
+            self.buffer.listeners.remove(self.lines_changed)
+        self.buffer = buffer
+        buffer.listeners.append(self.lines_changed)
+    def lines_changed(self, start, old_lines, new_count):
+        if not self.replaying and not self.buffer.grafting:
+            self.record(start, list(old_lines), self.buffer[start:start + new_count])
+    def swapped(self, old_buffer, new_buffer):
+        if not self.replaying and old_buffer is not new_buffer:
+            self.record(None, old_buffer, new_buffer)
+    @contextmanager
+    def unit(self, kind):
+        if self.pending is not None:
+            yield
+            return
+        self.pending = SimpleNamespace(kind=kind, before=self.cursor())
+        try:
+            yield
+        finally:
+            unit, self.current, self.pending = self.current, None, None
+            if unit is not None:
+                unit.after = self.cursor()
+                unit.last = time.monotonic()
+    def record(self, start, old_lines, new_lines):
+        for unit in self.redo_units:
+            self.lines -= unit.lines
+        self.redo_units.clear()
+        unit = self.current
+        if unit is None:
+            kind, before = (self.pending.kind, self.pending.before) if self.pending else ('edit', self.cursor())
+            top = self.undo_units[-1] if self.undo_units else None
+            if kind == 'type' and top is not None and top.kind == 'type' and time.monotonic() - top.last < self.MERGE_SECONDS:
+                unit = top
+            else:
+                unit = SimpleNamespace(kind=kind, ops=[], before=before, after=None, last=0.0, lines=0)
+                self.undo_units.append(unit)
+            if self.pending is not None:
+                self.current = unit
+        last = unit.ops[-1] if unit.ops else None
+        if start is not None and last is not None and last[0] is not None:
+            if last[0] == start and len(old_lines) == len(new_lines) == len(last[2]) == 1 and last[2][0] == old_lines[0]:
+                unit.ops[-1] = (start, last[1], new_lines)
+                return
+            if not old_lines and not last[1] and start == last[0] + len(last[2]):
+                last[2].extend(new_lines)
+                unit.lines += len(new_lines)
+                self.lines += len(new_lines)
+                self.trim()
+                return
+        unit.ops.append((start, old_lines, new_lines))
+        size = len(old_lines) if start is None else len(old_lines) + len(new_lines)
+        unit.lines += size
+        self.lines += size
+        self.trim()
+    def trim(self):
+        while len(self.undo_units) > 1 and (self.lines > self.MAX_LINES or len(self.undo_units) > self.MAX_UNITS):
+            self.lines -= self.undo_units.pop(0).lines
+    def undo(self):
+        # The cursor from before the unit, or None when there is nothing to undo.
+        if not self.undo_units:
+            return None
+        unit = self.undo_units.pop()
+        if unit.after is None:
+            unit.after = self.cursor()
+        self.replay([(start, new_lines, old_lines) for start, old_lines, new_lines in reversed(unit.ops)])
+        self.redo_units.append(unit)
+        return unit.before
+    def redo(self):
+        if not self.redo_units:
+            return None
+        unit = self.redo_units.pop()
+        self.replay(unit.ops)
+        self.undo_units.append(unit)
+        return unit.after
+    def replay(self, ops):
+        self.replaying = True
+        try:
+            for start, old_lines, new_lines in ops:
+                if start is None:
+                    self.swap(new_lines)
+                elif len(old_lines) == len(new_lines):
+                    for offset, line in enumerate(new_lines):
+                        self.buffer[start + offset] = line
+                else:
+                    self.buffer.replace_lines(start, start + len(old_lines), new_lines)
+        finally:
+            self.replaying = False
+
+class PatchEngine:
+    # Applies edits sent as search/replace blocks or unified diff hunks.  Each hunk is looked for
+    # exactly, then ignoring indentation and trailing space, then fuzzily by voting on the lines it
+    # shares with the buffer; matches that are ambiguous, missing or overlap an earlier hunk are
+    # reported as conflicts and skipped.  The accepted hunks are spliced in one pass.
+    FUZZY_RATIO = 0.8
+    search_start = re.compile(r'^\s*<{5,9} ?SEARCH\s*$')
+    divider = re.compile(r'^\s*={5,9}\s*$')
+    replace_end = re.compile(r'^\s*>{5,9} ?REPLACE\s*$')
+    hunk_header = re.compile(r'^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@')
+    def parse(self, content):
+        hunks = []
+        lines = content.split('\n')
+        i = 0
+        while i < len(lines):
+            header = self.hunk_header.match(lines[i])
+            if self.search_start.match(lines[i]):
+                search, replace = [], []
+                i += 1
+                while i < len(lines) and not self.divider.match(lines[i]):
+                    search.append(lines[i])
+                    i += 1
+                i += 1
+                while i < len(lines) and not self.replace_end.match(lines[i]):
+                    replace.append(lines[i])
+                    i += 1
+                hunks.append(SimpleNamespace(search=search, replace=replace, hint=None))
+            elif header:
+                search, replace = [], []
+                i += 1
+                while i < len(lines) and not self.hunk_header.match(lines[i]) and not lines[i].startswith(('--- ', '+++ ', '```')):
+                    line = lines[i]
+                    if line.startswith('-'):
+                        search.append(line[1:])
+                    elif line.startswith('+'):
+                        replace.append(line[1:])
+                    elif line.startswith(' ') or line == '':
+                        search.append(line[1:])
+                        replace.append(line[1:])
+                    elif not line.startswith('\\'):
+                        break
+                    i += 1
+                while search and replace and search[-1] == replace[-1] == '':
+                    search.pop()
+                    replace.pop()
+                hunks.append(SimpleNamespace(search=search, replace=replace, hint=int(header.group(1)) - 1))
+                continue
+            i += 1
+        return hunks
+    def apply(self, lines, hunks):
+        lines = list(lines)
+        keys = [line.strip() for line in lines]
+        edits = []
+        results = []
+        for number, hunk in enumerate(hunks, start=1):
+            found = self.locate(lines, keys, hunk)
+            if isinstance(found, str):
+                results.append(SimpleNamespace(number=number, status='conflict', line=None, reason=found, edit=None))
+                continue
+            start, end, how, replacement = found
+            if any(start < other_end and other_start < end or start == end == other_start for other_start, other_end, _ in edits):
+                results.append(SimpleNamespace(number=number, status='conflict', line=None, reason='overlaps an earlier hunk', edit=None))
+                continue
+            results.append(SimpleNamespace(number=number, status=how, line=start, reason='', edit=len(edits)))
+            edits.append((start, end, replacement))
+        patched = []
+        landed = {}
+        pos = 0
+        for edit in sorted(range(len(edits)), key=lambda edit: edits[edit][0]):
+            start, end, replacement = edits[edit]
+            patched.extend(lines[pos:start])
+            landed[edit] = len(patched)
+            patched.extend(replacement)
+            pos = end
+        patched.extend(lines[pos:])
+        for result in results:
+            if result.edit is not None:
+                result.line = landed[result.edit]
+        return patched, results
+    def locate(self, lines, keys, hunk):
+        search = hunk.search
+        if not any(line.strip() for line in search):
+            at = len(lines) if hunk.hint is None else max(0, min(hunk.hint, len(lines)))
+            end = at + len(search) if lines[at:at + len(search)] == search else at
+            return at, end, 'insert', hunk.replace
+        anchor = next(k for k, line in enumerate(search) if line.strip())
+        starts = [p - anchor for p, line in enumerate(lines) if line == search[anchor] and p >= anchor]
+        exact = [start for start in starts if lines[start:start + len(search)] == search]
+        if exact:
+            return self.choose(exact, hunk, len(search), 'exact', hunk.replace)
+        search_keys = [line.strip() for line in search]
+        starts = [p - anchor for p, key in enumerate(keys) if key == search_keys[anchor] and p >= anchor]
+        loose = [start for start in starts if keys[start:start + len(search)] == search_keys]
+        if loose:
+            return self.choose(loose, hunk, len(search), 'loose', self.reindent(hunk.replace, lines[loose[0] + anchor], search[anchor]))
+        votes = {}
+        positions = {}
+        for p, key in enumerate(keys):
+            if key:
+                positions.setdefault(key, []).append(p)
+        for k, key in enumerate(search_keys):
+            for p in positions.get(key, ()) if key else ():
+                votes[p - k] = votes.get(p - k, 0) + 1
+        needed = sum(1 for key in search_keys if key)
+        fuzzy = []
+        for start, count in sorted(votes.items(), key=lambda vote: -vote[1]):
+            if count < needed * self.FUZZY_RATIO / 2:
+                break
+            if start < 0:
+                continue
+            ratio = difflib.SequenceMatcher(None, '\n'.join(keys[start:start + len(search)]), '\n'.join(search_keys)).ratio()
+            if ratio >= self.FUZZY_RATIO:
+                fuzzy.append((ratio, start))
+        if not fuzzy:
+            return f"search text not found: {search[anchor].strip()[:48]!r}"
+        best = max(ratio for ratio, _ in fuzzy)
+        fuzzy = [start for ratio, start in fuzzy if ratio == best]
+        return self.choose(fuzzy, hunk, len(search), 'fuzzy', self.reindent(hunk.replace, lines[fuzzy[0] + anchor], search[anchor]))
+    def choose(self, starts, hunk, length, how, replacement):
+        if len(starts) > 1:
+            if hunk.hint is None:
+                return f"search text matches {len(starts)} places"
+            starts = [min(starts, key=lambda start: abs(start - hunk.hint))]
+        return starts[0], starts[0] + length, how, replacement
+    def reindent(self, replacement, found_line, search_line):
+        have = found_line[:len(found_line) - len(found_line.lstrip())]
+        want = search_line[:len(search_line) - len(search_line.lstrip())]
+        if have == want:
+            return replacement
+        return [have + line[len(want):] if line.strip() and line.startswith(want) else line for line in replacement]
+
+class SparseCorrector:
+    # Corrections sent as "line|offset|original|replacement", one per line, against a numbered copy
+    # of the window.  Each edit is checked against the buffer, near its offset and then on the lines
+    # either side; edits that no longer match or overlap another are rejected.  Accepted edits are
+    # applied right to left within each line, so only the corrected lines are rewritten.
+    edit_pattern = re.compile(r'^\s*(\d+)\s*\|\s*(\d+)\s*\|(.*?)\|(.*)$')
+    def numbered(self, lines, first=1):
+        return ''.join(f"{line_num}|{line}\n" for line_num, line in enumerate(lines, start=first) if line.strip())
+    def parse(self, content):
+        edits = []
+        for line in content.split('\n'):
+            match = self.edit_pattern.match(line)
+            if match and match.group(3):
+                edits.append((int(match.group(1)) - 1, int(match.group(2)), match.group(3), match.group(4)))
+        return edits
+    def locate(self, line, offset, original):
+        for text in (original, original.strip()):
+            if not text:
+                continue
+            if line[offset:offset + len(text)] == text:
+                return offset, text
+            found = [match.start() for match in re.finditer(re.escape(text), line)]
+            if found:
+                return min(found, key=lambda start: abs(start - offset)), text
+        return None
+    def apply(self, buffer, edits, cursor=None):
+        by_line = {}
+        rejected = 0
+        for line_num, offset, original, replacement in edits:
+            for candidate in (line_num, line_num - 1, line_num + 1):
+                if 0 <= candidate < len(buffer):
+                    found = self.locate(buffer[candidate], offset, original)
+                    if found:
+                        start, text = found
+                        if text != original:
+                            replacement = replacement.strip()
+                        by_line.setdefault(candidate, []).append((start, start + len(text), replacement))
+                        break
+            else:
+                rejected += 1
+        applied = 0
+        for line_num, line_edits in by_line.items():
+            line = buffer[line_num]
+            accepted = []
+            for start, end, replacement in sorted(line_edits):
+                if accepted and start < accepted[-1][1]:
+                    rejected += 1
+                    continue
+                accepted.append((start, end, replacement))
+            for start, end, replacement in reversed(accepted):
+                line = line[:start] + replacement + line[end:]
+                if cursor and cursor[0] == line_num and end <= cursor[1]:
+                    cursor = (cursor[0], cursor[1] + len(replacement) - (end - start))
+            if line != buffer[line_num]:
+                buffer[line_num] = line
+            applied += len(accepted)
+        return applied, rejected, cursor
+
+class ResponseCache:
+    # Replies keyed by a hash of model, max_tokens and messages, kept in sqlite.  Least recently
+    # used entries are evicted past max_bytes and entries older than ttl seconds are ignored.
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, content TEXT, size INTEGER, created REAL, used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS replies_used ON replies (used)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM replies").fetchone()[0]
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT content, created, size FROM replies WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM replies WHERE key = ?", (key,))
+                self.conn.commit()
+                self.total_bytes -= row[2]
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE replies SET used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+    def put(self, key, content):
+        now = time.time()
+        size = len(content.encode())
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM replies WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?)", (key, content, size, now, now))
+            self.total_bytes += size - (old[0] if old else 0)
+            while self.total_bytes > self.max_bytes:
+                oldest = self.conn.execute("SELECT key, size FROM replies WHERE key != ? ORDER BY used LIMIT 64", (key,)).fetchall()
+                if not oldest:
+                    break
+                for old_key, old_size in oldest:
+                    self.conn.execute("DELETE FROM replies WHERE key = ?", (old_key,))
+                    self.total_bytes -= old_size
+                    if self.total_bytes <= self.max_bytes:
+                        break
+            self.conn.commit()
+    def describe(self):
+        return f"cache {self.hits}/{self.hits + self.misses}"
+
+class TokenBudget:
+    # Token counts for prompts, from tiktoken when it is installed and has its encodings locally, or
+    # else from a character and word estimate, so counting never needs the network.  fit() holds a
+    # prompt to a budget: the leading system messages are the instructions and are kept whole,
+    # earlier assistant replies are dropped first, then the largest remaining messages lose lines
+    # from the middle.
+    MESSAGE_OVERHEAD = 4
+    REPLY_PRIMING = 3
+    CACHE_SIZE = 4096
+    word_pattern = re.compile(r'\w+|[^\w\s]')
+    sentence_end = re.compile(r'[.!?]["\')\]]*\s*$')
+    def __init__(self):
+        self.encodings = {}
+        self.counts = {}
+    def encoding(self, model):
+        if model not in self.encodings:
+            self.encodings[model] = None
+            if tiktoken is not None:
+                try:
+                    self.encodings[model] = tiktoken.encoding_for_model(model)
+                except Exception:
+                    pass
+        return self.encodings[model]
+    def count(self, text, model):
+        key = (model, text)
+        if key not in self.counts:
+            if len(self.counts) >= self.CACHE_SIZE:
+                self.counts.clear()
+            encoding = self.encoding(model)
+            if encoding is not None:
+                self.counts[key] = len(encoding.encode(text, disallowed_special=()))
+            else:
+                self.counts[key] = max(len(text) // 4, len(self.word_pattern.findall(text)))
+        return self.counts[key]
+    def prompt_tokens(self, messages, model):
+        return sum(self.count(message["content"], model) + self.MESSAGE_OVERHEAD for message in messages) + self.REPLY_PRIMING
+    def fit(self, messages, budget, model):
+        messages = [dict(message) for message in messages]
+        total = self.prompt_tokens(messages, model)
+        report = SimpleNamespace(prompt=total, dropped=0, elided=0, over=False)
+        if not budget or total <= budget:
+            return messages, report
+        keep = 0
+        while keep < len(messages) - 1 and messages[keep]["role"] == "system":
+            keep += 1
+        for message in messages[keep:-1]:
+            if total > budget and message["role"] == "assistant":
+                total -= self.count(message["content"], model) + self.MESSAGE_OVERHEAD
+                message["dropped"] = True
+                report.dropped += 1
+        messages = [message for message in messages if not message.pop("dropped", False)]
+        for message in sorted(messages[keep:], key=lambda message: -self.count(message["content"], model)):
+            if total <= budget:
+                break
+            count = self.count(message["content"], model)
+            message["content"], elided = self.elide(message["content"], count - (total - budget), model)
+            total += self.count(message["content"], model) - count
+            report.elided += elided
+        report.prompt = self.prompt_tokens(messages, model)
+        report.over = report.prompt > budget
+        return messages, report
+    def chunk_lines(self, lines, chunk_tokens, model):
+        # Split lines into (start, end) spans of at most chunk_tokens, breaking between paragraphs
+        # where possible, then after a line that ends a sentence, then anywhere between lines.
+        spans = []
+        start = 0
+        spent = 0
+        best_break = None
+        for line_num, line in enumerate(lines):
+            cost = self.count(line, model) + 1
+            if spent + cost > chunk_tokens and line_num > start:
+                end = best_break[1] if best_break else line_num
+                spans.append((start, end))
+                start = end
+                spent = sum(self.count(lines[i], model) + 1 for i in range(start, line_num))
+                best_break = None
+            spent += cost
+            rank = 2 if not line.strip() else 1 if self.sentence_end.search(line) else 0
+            if best_break is None or rank >= best_break[0]:
+                best_break = (rank, line_num + 1)
+        if start < len(lines):
+            spans.append((start, len(lines)))
+        return spans
+    def elide(self, text, target, model):
+        # Keep lines from both ends of the text within target tokens; returns the text and the
+        # number of lines left out.  A single long line is cut by characters instead.
+        lines = text.split('\n')
+        if len(lines) == 1:
+            keep = max(0, len(text) * max(0, target - 8) // max(1, self.count(text, model)) // 2)
+            return f"{text[:keep]} [... {len(text) - 2 * keep} characters elided ...] {text[len(text) - keep:]}", 0
+        head, tail = [], []
+        spent = 8
+        while len(head) + len(tail) < len(lines):
+            line = lines[len(head)] if len(head) <= len(tail) else lines[len(lines) - 1 - len(tail)]
+            spent += self.count(line, model) + 1
+            if spent > target:
+                break
+            (head if len(head) <= len(tail) else tail).append(line)
+        elided = len(lines) - len(head) - len(tail)
+        return '\n'.join(head + [f"[... {elided} lines elided ...]"] + tail[::-1]), elided
 
 class CogEngine:
-    def __init__(self, viewpoints):
+    def __init__(self, viewpoints, cache=None):
         self.cognalities = viewpoints
+        self.cache = cache
+        self.budget = TokenBudget()
         self.cogessages = []
         self.usermsg = []
+        self.ttft = None
     def reset(self, viewpoint):
         self.cogessages = []
         self.usermsg = []
@@ -51,59 +1247,139 @@ class CogEngine:
         return context
     def add_usermsg(self, msg):
         self.usermsg.append(msg)
-    def ai_query(self, viewpoints):
-        reform = client.chat.completions.create(
-            model = viewpoints.get_model(),
-            max_tokens = viewpoints.get_maxtokens(),
-            messages = self.get_cogtext()
-        )
-        self.add_cogtext("assistant", reform.choices[0].message.content)
-        return reform
+    def complete(self, model, max_tokens, messages, on_delta=None, cancelled=None, use_cache=True):
+        started = time.monotonic()
+        key = None
+        if self.cache and use_cache:
+            key = fingerprint(model, max_tokens, messages)
+            content = self.cache.get(key)
+            if content is not None:
+                return CogReply(content), time.monotonic() - started
+        reform, ttft = self.query_backend(model, max_tokens, messages, on_delta, cancelled, started)
+        if key and reform is not None:
+            self.cache.put(key, reform.choices[0].message.content)
+        return reform, ttft
+    def query_backend(self, model, max_tokens, messages, on_delta, cancelled, started):
+        if on_delta is None:
+            reform = backend.complete(model, max_tokens, messages)
+            return reform, time.monotonic() - started
+        ttft = None
+        stream = backend.stream(model, max_tokens, messages)
+        content = []
+        try:
+            for delta in stream:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                content.append(delta)
+                on_delta(delta)
+                if cancelled and cancelled():
+                    return None, ttft
+        finally:
+            stream.close()
+        return CogReply("".join(content)), ttft
     def save_cogtext(self):
-        with open("debug_cogf.cogf", 'w') as cogf:
-            json.dump({
-                "model": self.cognalities.get_model(),
-                "max_tokens": self.cognalities.get_maxtokens(),
-                "messages": self.get_cogtext()
-            }, cogf)
+        writer.replace("debug_cogf.cogf", json.dumps({
+            "model": self.cognalities.get_model(),
+            "max_tokens": self.cognalities.get_maxtokens(),
+            "messages": self.get_cogtext()
+        }))
     def extract_objects(self, content):
-        obj_pattern = re.compile(r'class\s+(\w+)|def\s+(\w+)\s*\((.*?)\):')
-        matches = obj_pattern.finditer(content)
         objects = []
-        current_class = None
-        for match in matches:
-            if match.group(1):
-                current_class = match.group(1)
-            else:
-                obj_name = match.group(2)
-                start_pos = match.start()
-                lines = content[start_pos:].splitlines()
-                code_block = []
-                indent_level = None
-                for line in lines:
-                    if '```' in line:
-                        break
-                    stripped_line = line.lstrip()
-                    if stripped_line.startswith('def') and code_block:
-                        break
-                    if stripped_line.startswith('class') and code_block:
-                        break
-                    if stripped_line and indent_level is None:
-                        indent_level = len(line) - len(stripped_line)
-                    if indent_level is not None:
-                        if len(line) - len(stripped_line) < indent_level and stripped_line:
-                            break
-                        code_block.append(line)
-                objects.append({
-                    'name': obj_name,
-                    'object': current_class,
-                    'code': '\n'.join(code_block)
-                })
-        with open(f"thissession.objs.debug", "a") as f:
-            for obj in objects:
-                f.write(f"Object: {obj['object']}\n")
-                f.write(f"Function: {obj['name']}\n")
-                f.write(f"Code:\n{obj['code']}\n")
+        for block_start, block in self.code_blocks(content.split('\n')):
+            objects.extend(self.parse_code_block(block, block_start))
+        return objects
+    def code_blocks(self, lines):
+        blocks = []
+        block_start = None
+        for line_num, line in enumerate(lines):
+            if line.lstrip().startswith('```'):
+                if block_start is None:
+                    block_start = line_num + 1
+                else:
+                    blocks.append((block_start, lines[block_start:line_num]))
+                    block_start = None
+        if block_start is not None:
+            blocks.append((block_start, lines[block_start:]))
+        if not blocks and not any(line.lstrip().startswith('```') for line in lines):
+            blocks.append((0, lines))
+        return blocks
+    def parse_code_block(self, lines, block_start):
+        source = textwrap.dedent("\n".join(lines))
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            return self.scan_code_fragment(source, block_start)
+        objects = []
+        self.collect_objects(tree.body, [], source.split('\n'), block_start, objects)
+        return objects
+    def collect_objects(self, nodes, classes, src_lines, block_start, objects):
+        for node in nodes:
+            if isinstance(node, ast.ClassDef):
+                self.collect_objects(node.body, classes + [node.name], src_lines, block_start, objects)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]) - 1
+                objects.append(self.code_object(node.name, classes, src_lines, start, node.end_lineno, block_start))
+    def code_object(self, name, classes, src_lines, start, end, block_start):
+        return {
+            'name': name,
+            'object': classes[-1] if classes else None,
+            'qualname': '.'.join(classes + [name]),
+            'code': textwrap.dedent('\n'.join(src_lines[start:end])),
+            'start': block_start + start,
+            'end': block_start + end
+        }
+    def scan_code_fragment(self, source, block_start):
+        # Fragments that do not parse (elided bodies, stray prose) are walked with the tokenizer:
+        # a def or class runs until the next logical line at the same or a shallower depth.
+        src_lines = source.split('\n')
+        objects = []
+        open_objects = []
+        depth = 0
+        at_line_start = True
+        decorator_start = None
+        expect_name = None
+        last_end = 0
+        def close(to_depth, end):
+            while open_objects and open_objects[-1]['depth'] >= to_depth:
+                opened = open_objects.pop()
+                if opened['kind'] == 'def' and opened['record']:
+                    objects.append(self.code_object(opened['name'], opened['classes'], src_lines, opened['start'], end, block_start))
+        try:
+            for token in tokenize.generate_tokens(io.StringIO(source + '\n').readline):
+                if token.type == tokenize.INDENT:
+                    depth += 1
+                    continue
+                if token.type == tokenize.DEDENT:
+                    depth -= 1
+                    continue
+                if token.type in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER):
+                    continue
+                if token.type == tokenize.NEWLINE:
+                    at_line_start = True
+                    last_end = token.start[0]
+                    continue
+                if at_line_start:
+                    at_line_start = False
+                    close(depth, last_end)
+                    if token.string == '@':
+                        if decorator_start is None:
+                            decorator_start = token.start[0] - 1
+                        continue
+                    if token.string in ('def', 'class', 'async'):
+                        expect_name = 'class' if token.string == 'class' else 'def'
+                        start = token.start[0] - 1 if decorator_start is None else decorator_start
+                    decorator_start = None
+                    continue
+                if expect_name and token.type == tokenize.NAME and token.string != 'def':
+                    classes = [opened['name'] for opened in open_objects if opened['kind'] == 'class']
+                    record = not any(opened['kind'] == 'def' for opened in open_objects)
+                    open_objects.append({'kind': expect_name, 'name': token.string, 'start': start, 'depth': depth, 'classes': classes, 'record': record})
+                    expect_name = None
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            last_end = len(src_lines)
+            while last_end > 0 and not src_lines[last_end - 1].strip():
+                last_end -= 1
+        close(0, last_end)
         return objects
 
 class Viewpoints:
@@ -119,8 +1395,10 @@ class Viewpoints:
                         ],
                         'model': 'gpt-3.5-turbo',
                         'max_tokens': 298,
+                        'prompt_budget': 3000,
                         'textops': ['Inline'],
-                        'role' : ['Editor']
+                        'role' : ['Editor'],
+                        'prefilter': True
                     },
                     'Python Coder': {
                         'attributes': [
@@ -134,8 +1412,29 @@ class Viewpoints:
                         ],
                         'model': 'gpt-4o',
                         'max_tokens': 4096,
+                        'prompt_budget': 24000,
                         'textops': ['Markup', 'Deprecate', 'Refactor', 'Concatenate'],
-                        'role' : ['Coder']
+                        'outline_over': 222,
+                        'outline_note': "Function bodies shown as '...' were left out to save space; write only the functions you change.",
+                        'role' : ['Coder'],
+                        'stream': True
+                    },
+                    'Python Patch': {
+                        'attributes': [
+                            'Your task is to code in python.',
+                            'You are very competent and good at writing code.',
+                            'Reply only with the edits, each as a search/replace block:\n<<<<<<< SEARCH\n(the current lines)\n=======\n(the new lines)\n>>>>>>> REPLACE',
+                            'Copy the SEARCH lines exactly, with just enough surrounding lines to make them unique.',
+                            'Do not repeat code that is not changing.  A unified diff is also accepted.'
+                        ],
+                        'model': 'gpt-4o',
+                        'max_tokens': 2048,
+                        'prompt_budget': 24000,
+                        'textops': ['Patch'],
+                        'outline_over': 222,
+                        'outline_note': "Function bodies shown as '...' were left out to save space; copy SEARCH lines only from code shown in full, never across a '...' line.",
+                        'role' : ['Coder'],
+                        'stream': True
                     },
                     'Grammar': {
                         'attributes': [
@@ -148,7 +1447,25 @@ class Viewpoints:
                         ],
                         'model': 'gpt-4o',
                         'max_tokens': 698,
+                        'prompt_budget': 6000,
+                        'chunk_tokens': 300,
                         'textops': ['Concatenate'],
+                        'role' : ['Editor'],
+                        'stream': True
+                    },
+                    'Proofread': {
+                        'attributes': [
+                            'Your only task is to correct misspelled words and grammar mistakes in the numbered lines.',
+                            'Reply only with the corrections, one per line, as: line|offset|original|replacement',
+                            'line is the line number, offset is the character offset of the original text in that line, starting at 0.',
+                            'Keep each original as short as possible, usually one word; do not repeat lines that need no correction.',
+                            'If there is nothing to correct, reply with nothing.'
+                        ],
+                        'model': 'gpt-4o',
+                        'max_tokens': 1024,
+                        'prompt_budget': 12000,
+                        'chunk_tokens': 2000,
+                        'textops': ['Sparse'],
                         'role' : ['Editor']
                     },
                     'Thesaurus': {
@@ -157,6 +1474,7 @@ class Viewpoints:
                         ],
                         'model': 'gpt-3.5-turbo',
                         'max_tokens': 398,
+                        'prompt_budget': 1000,
                         'textops': ['Inline'],
                         'role' : ['Editor']
                     },
@@ -164,8 +1482,11 @@ class Viewpoints:
                         'attributes': [],
                         'model': 'gpt-4o',
                         'max_tokens': 4096,
+                        'prompt_budget': 24000,
                         'textops': ['Concatenate'],
-                        'role' : ['Editor']
+                        'role' : ['Editor'],
+                        'stream': True,
+                        'cache': False
                     },
                     'Telephone': {
                         'attributes': [
@@ -173,8 +1494,10 @@ class Viewpoints:
                         ],
                         'model': 'gpt-3.5-turbo',
                         'max_tokens': 298,
+                        'prompt_budget': 1000,
                         'textops': ['Inline'],
-                        'role' : ['Editor']
+                        'role' : ['Editor'],
+                        'cache': False
                     },
                     'Ctx Summary': {
                         'attributes': [
@@ -183,6 +1506,7 @@ class Viewpoints:
                         ],
                         'model': 'gpt-3.5-turbo',
                         'max_tokens': 698,
+                        'prompt_budget': 3000,
                         'textops': ['replace'],
                         'role' : ['Editor', 'System', 'Hidden']
                     }
@@ -201,10 +1525,32 @@ class Viewpoints:
             return self.viewpoints[self.get_current_name()]['model']
         def get_maxtokens(self):
             return self.viewpoints[self.get_current_name()]['max_tokens']
+        def get_prompt_budget(self):
+            return self.viewpoints[self.get_current_name()].get('prompt_budget')
+        def get_prefilter(self):
+            return self.viewpoints[self.get_current_name()].get('prefilter', False)
+        def get_chunk_tokens(self):
+            return self.viewpoints[self.get_current_name()].get('chunk_tokens')
+        def get_outline_over(self):
+            return self.viewpoints[self.get_current_name()].get('outline_over')
+        def get_outline_note(self):
+            return self.viewpoints[self.get_current_name()].get('outline_note')
         def get_textops(self):
             return self.viewpoints[self.get_current_name()]['textops']
         def get_role(self):
             return self.viewpoints[self.get_current_name()]['role']
+        def get_stream(self):
+            return self.viewpoints[self.get_current_name()].get('stream', False)
+        def get_cache(self):
+            return self.viewpoints[self.get_current_name()].get('cache', True)
+        @contextmanager
+        def pinned(self, name):
+            current_index = self.current_index
+            self.current_index = self.names.index(name)
+            try:
+                yield
+            finally:
+                self.current_index = current_index
         def next_viewpoint(self):
                 starting_index = self.current_index
                 while True:
@@ -217,25 +1563,318 @@ class Viewpoints:
         def get_attributes_by_name(self, name):
             return self.viewpoints.get(name, {}).get('attributes', [])
 
+class RevisionStore:
+    # Every revision and subrevision of a session lives in one append-only file.  A record is a
+    # JSON header line followed by a zlib payload: the text and ctx lines as a delta against the
+    # previous record, or in full on every KEYFRAME_INTERVAL-th record of a chain.  put() only
+    # indexes the record and keeps it in pending; the writer thread works out the delta, compresses
+    # and appends it, and reads come from pending until the record can be read back from disk.
+    KEYFRAME_INTERVAL = 16
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.last_key = None
+        self.last_record = None
+        self.max_rev = 0
+        self.cache = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.end_offset = 0
+        self.load_index()
+    def load_index(self):
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    header = json.loads(line)
+                except ValueError:
+                    break
+                header['offset'] = f.tell()
+                if header['offset'] + header['len'] > size:
+                    break
+                f.seek(header['len'], 1)
+                self.add_to_index(header)
+                self.end_offset = f.tell()
+        if self.end_offset < size:
+            os.truncate(self.path, self.end_offset)
+    def add_to_index(self, header):
+        self.index.pop(header['key'], None)
+        self.index[header['key']] = header
+        self.last_key = header['key']
+        self.max_rev = max(self.max_rev, header['rev'])
+    @staticmethod
+    def revision_key(rev_num):
+        return f"r{rev_num}"
+    @staticmethod
+    def subrevision_key(rev_num, subrev_num):
+        return f"s{rev_num}.{subrev_num}"
+    @staticmethod
+    def delta(base, lines):
+        prefix = 0
+        while prefix < min(len(base), len(lines)) and base[prefix] == lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < min(len(base), len(lines)) - prefix and base[-1 - suffix] == lines[-1 - suffix]:
+            suffix += 1
+        ops = [["=", 0, prefix]] if prefix else []
+        matcher = difflib.SequenceMatcher(None, base[prefix:len(base) - suffix], lines[prefix:len(lines) - suffix])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                ops.append(["=", prefix + i1, prefix + i2])
+            elif tag in ('replace', 'insert'):
+                ops.append(["+", lines[prefix + j1:prefix + j2]])
+        if suffix:
+            ops.append(["=", len(base) - suffix, len(base)])
+        return ops
+    @staticmethod
+    def patch(base, ops):
+        lines = []
+        for op in ops:
+            if op[0] == '=':
+                lines.extend(base[op[1]:op[2]])
+            else:
+                lines.extend(op[1])
+        return lines
+    def put_revision(self, rev_num, text, ctx):
+        self.put(self.revision_key(rev_num), 'rev', rev_num, 0, text, ctx, 'Revision')
+    def put_subrevision(self, rev_num, subrev_num, text, ctx, subrev_type):
+        self.put(self.subrevision_key(rev_num, subrev_num), 'subrev', rev_num, subrev_num, text, ctx, subrev_type)
+    def put(self, key, kind, rev_num, subrev_num, text, ctx, subrev_type):
+        # text may also be a function returning the lines, for text read from disk on the writer thread.
+        record = {"text": None if callable(text) else LineSnapshot.of(text), "ctx": LineSnapshot.of(ctx), "type": subrev_type}
+        parent = self.last_key
+        depth = self.index[parent]['depth'] + 1 if parent else 0
+        if depth % self.KEYFRAME_INTERVAL == 0:
+            parent, depth = None, 0
+        base = self.last_record if parent else None
+        header = {"key": key, "kind": kind, "rev": rev_num, "sub": subrev_num, "type": subrev_type, "parent": parent, "depth": depth, "time": time.time()}
+        with self.lock:
+            self.pending[key] = record
+        self.add_to_index(header)
+        self.last_record = record
+        writer.append(self.path, lambda: self.encode(header, record, base, text))
+        writer.call(lambda: self.written(header))
+        self.remember(key, record)
+    def encode(self, header, record, base, text):
+        # Runs on the writer thread, in append order, so end_offset is only advanced here.  base is
+        # the parent's record, or None for a keyframe or a parent left on disk by an earlier session.
+        if record["text"] is None:
+            record["text"] = LineSnapshot.of(text())
+        text, ctx = list(record["text"]), list(record["ctx"])
+        if header['parent'] is None:
+            payload = {"text": text, "ctx": ctx}
+        else:
+            base = base or self.load(header['parent'])
+            payload = {"text": self.delta(list(base["text"]), text), "ctx": self.delta(list(base["ctx"]), ctx)}
+        data = zlib.compress(json.dumps(payload, separators=(',', ':')).encode())
+        header['len'] = len(data)
+        header_line = (json.dumps(header) + '\n').encode()
+        header['offset'] = self.end_offset + len(header_line)
+        self.end_offset = header['offset'] + len(data)
+        return header_line + data
+    def written(self, header):
+        # A record whose append failed stays in pending, so this session can still read it.
+        if 'offset' in header:
+            with self.lock:
+                self.pending.pop(header['key'], None)
+    def remember(self, key, record):
+        self.cache.pop(key, None)
+        self.cache[key] = record
+        while len(self.cache) > 4:
+            self.cache.pop(next(iter(self.cache)))
+    def read_payload(self, header):
+        with open(self.path, 'rb') as f:
+            f.seek(header['offset'])
+            return json.loads(zlib.decompress(f.read(header['len'])))
+    def held(self, key, use_cache):
+        if use_cache and key in self.cache:
+            return self.cache[key]
+        with self.lock:
+            return self.pending.get(key)
+    def load(self, key, use_cache=False):
+        # Rebuilds a record from the nearest keyframe, or from the nearest ancestor held in memory.
+        # Only the UI thread uses the cache; the writer thread sees just the pending records.
+        header = self.index[key]
+        chain = [header]
+        while chain[-1]['parent'] is not None and self.held(chain[-1]['parent'], use_cache) is None:
+            chain.append(self.index[chain[-1]['parent']])
+        if chain[-1]['parent'] is None:
+            payload = self.read_payload(chain.pop())
+            base = {"text": payload["text"], "ctx": payload["ctx"]}
+        else:
+            base = self.held(chain[-1]['parent'], use_cache)
+        for link in reversed(chain):
+            payload = self.read_payload(link)
+            base = {"text": self.patch(list(base["text"]), payload["text"]), "ctx": self.patch(list(base["ctx"]), payload["ctx"])}
+        return {"text": base["text"], "ctx": base["ctx"], "type": header['type']}
+    def get(self, key):
+        record = self.held(key, True)
+        if record is not None and record["text"] is None:
+            writer.wait_for(self.path)
+        if record is None:
+            if key not in self.index:
+                return None
+            record = self.load(key, True)
+        self.remember(key, record)
+        return record
+    def keys(self, kind=None):
+        return [key for key, header in self.index.items() if kind is None or header['kind'] == kind]
+    def import_legacy(self, session_name, session_suffix):
+        # Pull the full copies written by earlier versions (<session>.<rev><suffix> and
+        # <session>.<rev>.<sub>.subrev) into the store; returns the files that were imported.
+        revision_pattern = re.compile(rf'{re.escape(session_name)}\.(\d+){re.escape(session_suffix)}')
+        subrev_pattern = re.compile(rf'{re.escape(session_name)}\.(\d+)\.(\d+)\.subrev')
+        legacy = []
+        for file in os.listdir('.'):
+            match = revision_pattern.fullmatch(file)
+            if match and session_suffix:
+                legacy.append(((int(match.group(1)), 0, 0), file))
+            match = subrev_pattern.fullmatch(file)
+            if match:
+                legacy.append(((int(match.group(1)), 1, int(match.group(2))), file))
+        imported = []
+        for (rev_num, is_subrev, subrev_num), file in sorted(legacy):
+            with open(file, 'r') as f:
+                lines = [line.rstrip('\n') for line in f]
+            if not is_subrev:
+                if self.revision_key(rev_num) not in self.index:
+                    self.put_revision(rev_num, lines, [])
+            elif self.subrevision_key(rev_num, subrev_num) not in self.index and len(lines) > 2 and "Subrevision Context:" in lines:
+                ctx_at = lines.index("Subrevision Context:")
+                self.put_subrevision(rev_num, subrev_num, lines[2:ctx_at - 1], lines[ctx_at + 1:], lines[0].replace("Subrevision Type: ", "", 1))
+            imported.append(file)
+        return imported
+    def compact(self, session_name=None, session_suffix=None):
+        writer.wait_for(self.path)
+        bytes_before = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        imported = self.import_legacy(session_name, session_suffix) if session_name else []
+        bytes_before += sum(os.path.getsize(file) for file in imported)
+        ordered = sorted(self.index.values(), key=lambda header: (header['rev'], header['kind'] != 'rev', header['sub']))
+        # A .compact file left by an interrupted run is discarded, not appended to, and the result
+        # only replaces the store when it is smaller.
+        if os.path.exists(self.path + '.compact'):
+            os.remove(self.path + '.compact')
+        compacted = RevisionStore(self.path + '.compact')
+        for header in ordered:
+            record = self.get(header['key'])
+            compacted.put(header['key'], header['kind'], header['rev'], header['sub'], record["text"], record["ctx"], header['type'])
+        writer.release(self.path)
+        writer.release(compacted.path)
+        writer.flush(sync=True)
+        replaced = bool(ordered) and os.path.getsize(compacted.path) < os.path.getsize(self.path)
+        if replaced:
+            os.replace(compacted.path, self.path)
+            self.index, self.last_key, self.max_rev, self.cache = compacted.index, compacted.last_key, compacted.max_rev, {}
+            self.last_record, self.end_offset = compacted.last_record, compacted.end_offset
+        elif os.path.exists(compacted.path):
+            os.remove(compacted.path)
+        for file in imported:
+            os.remove(file)
+        return bytes_before, os.path.getsize(self.path) if os.path.exists(self.path) else 0, replaced
+
+class RevisionManifest:
+    # Append-only index of a session's revisions, subrevisions and ctx journals, one entry per line,
+    # so the next revision number is known without listing the directory.  It is rebuilt from a
+    # directory scan when the file is missing or behind the store or the ctx files on disk.
+    def __init__(self, session_name, session_suffix, store):
+        self.session_name = session_name
+        self.session_suffix = session_suffix
+        self.store = store
+        self.path = f'{session_name}.qkman'
+        self.max_rev = 0
+        self.subrevisions = {}
+        self.ctx_files = set()
+        if not self.load() or self.is_stale():
+            self.rebuild()
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    self.apply(line.rstrip('\n'))
+                except (ValueError, IndexError):
+                    return False
+        return True
+    def apply(self, entry):
+        kind, rev, rest = (entry.split(' ', 2) + [''])[:3]
+        rev = int(rev)
+        self.max_rev = max(self.max_rev, rev)
+        if kind == 'subrev':
+            subrev_num, subrev_type = (rest.split(' ', 1) + [''])[:2]
+            self.subrevisions[(rev, int(subrev_num))] = subrev_type
+        elif kind == 'ctx':
+            self.ctx_files.add(rest)
+    def is_stale(self):
+        return self.store.max_rev > self.max_rev or os.path.exists(f'{self.session_name}.{self.max_rev + 1}.ctx')
+    def rebuild(self):
+        pattern = re.compile(rf'{re.escape(self.session_name)}\.(\d+)(?:{re.escape(self.session_suffix)}|\.cog\.json|\.ctx)')
+        entries = []
+        for file in os.listdir('.'):
+            match = pattern.fullmatch(file)
+            if match:
+                entries.append(f"ctx {match.group(1)} {file}" if file.endswith('.ctx') else f"rev {match.group(1)}")
+        for key in self.store.keys():
+            header = self.store.index[key]
+            entries.append(f"rev {header['rev']}" if header['kind'] == 'rev' else f"subrev {header['rev']} {header['sub']} {header['type']}")
+        self.max_rev = 0
+        self.subrevisions = {}
+        self.ctx_files = set()
+        for entry in entries:
+            self.apply(entry)
+        writer.replace(self.path, "".join(entry + '\n' for entry in entries))
+    def record(self, *fields):
+        entry = " ".join(str(field) for field in fields)
+        writer.append(self.path, entry + '\n')
+        self.apply(entry)
+    def next_rev(self):
+        rev_num = self.max_rev + 1
+        while os.path.exists(f'{self.session_name}.{rev_num}.ctx'):
+            rev_num += 1
+        self.record('rev', rev_num)
+        return rev_num
+    def record_ctx(self, rev_num, ctx_filename):
+        if ctx_filename not in self.ctx_files:
+            self.record('ctx', rev_num, ctx_filename)
+
 class EditRevisionManager:
+    CTX_SUMMARY_DELAY = 2.0
+    # Subrevisions are listed in subrevisions by number with their type and revision; their text
+    # and ctx sit in bodies, least recently used first, and past args.subrev_cache bodies the oldest
+    # are dropped and read back from the store when asked for.
     def __init__(self, session_name_with_suffix, cogengine):
         self.revisions = {}
         self.subrevisions = {}
+        self.bodies = {}
+        self.prefetch_num = None
         self.subrev_type = 'original'
         self.subrev_num = 0
         self.subrev_being_viewed = 0
         self.original_filename = session_name_with_suffix
         self.session_name, self.session_suffix = os.path.splitext(session_name_with_suffix)
+        self.store = RevisionStore(f'{self.session_name}.qkrev')
+        self.manifest = RevisionManifest(self.session_name, self.session_suffix, self.store)
         self.rev_num = self.find_latest_file_rev_num() + 1
         self.cog_filename = f'{self.session_name}.{self.rev_num}.cog.json'
         self.cogengine = cogengine
         self.edit_filename = f'{self.session_name}.{self.rev_num}{self.session_suffix}'
         self.ctx_filename = f'{self.session_name}.{self.rev_num}.ctx'
         self.ctx_summary = ""
+        self.ctx_folded = 0
+        self.ctx_folded_lines = ()
+        self.ctx_summary_due = None
     def store_revision(self, rev_num, text):
-        self.revisions[rev_num] = list(text)
+        self.revisions[rev_num] = LineSnapshot.of(text)
     def get_revision(self, rev_num):
-        return self.revisions.get(rev_num, [])
+        if rev_num in self.revisions:
+            return self.revisions[rev_num]
+        record = self.store.get(self.store.revision_key(rev_num))
+        return record["text"] if record else []
     def get_latest_revision(self):
         if self.revisions:
             max_rev_num = max(self.revisions.keys())
@@ -244,66 +1883,83 @@ class EditRevisionManager:
     def store_subrevision(self, subrev_text, subrev_ctx, subrev_type):
             self.subrev_num += 1
             self.subrev_type = subrev_type
-            self.subrevisions[self.subrev_num] = {
-                "text": list(subrev_text),
-                "ctx": list(subrev_ctx),
-                "type": subrev_type
+            body = {
+                "text": LineSnapshot.of(subrev_text),
+                "ctx": LineSnapshot.of(subrev_ctx)
             }
-            subrev_filename = f'{self.session_name}.{self.rev_num}.{self.subrev_num}.subrev'
-            with open(subrev_filename, 'w') as f:
-                f.write(f"Subrevision Type: {subrev_type}\n")
-                f.write("Subrevision Text:\n")
-                for line in subrev_text:
-                    f.write(line + '\n')
-                f.write("\nSubrevision Context:\n")
-                for line in subrev_ctx:
-                    f.write(line + '\n')
+            self.subrevisions[self.subrev_num] = {"type": subrev_type, "rev": self.rev_num}
+            self.keep_body(self.subrev_num, body)
+            self.store.put_subrevision(self.rev_num, self.subrev_num, body["text"], body["ctx"], subrev_type)
+            self.manifest.record('subrev', self.rev_num, self.subrev_num, subrev_type)
+            return body["text"]
+    def keep_body(self, subrev_num, body):
+        self.bodies.pop(subrev_num, None)
+        self.bodies[subrev_num] = body
+        while len(self.bodies) > max(1, args.subrev_cache):
+            self.bodies.pop(next(iter(self.bodies)))
+    def get_subrevision_body(self, subrev_num, keep=True):
+        body = self.bodies.get(subrev_num)
+        if body is not None:
+            if keep:
+                self.keep_body(subrev_num, body)
+            return body
+        subrevision = self.subrevisions.get(subrev_num)
+        if subrevision is None:
+            return None
+        record = self.store.get(self.store.subrevision_key(subrevision["rev"], subrev_num))
+        if record is None:
+            return None
+        body = {"text": LineSnapshot.of(record["text"]), "ctx": LineSnapshot.of(record["ctx"])}
+        if keep:
+            self.keep_body(subrev_num, body)
+        return body
     def get_subrevision_text(self, subrev_num):
         self.subrev_being_viewed = subrev_num
-        subrevision = self.subrevisions.get(subrev_num)
-        if subrevision:
-            return subrevision.get("text")
+        body = self.get_subrevision_body(subrev_num)
+        if body:
+            self.prefetch_num = subrev_num + 1
+            return body["text"]
         return None
+    def prefetch(self):
+        # Called when the editor is idle, so the next Ctrl-T finds its subrevision in memory.
+        subrev_num, self.prefetch_num = self.prefetch_num, None
+        if subrev_num is not None and subrev_num not in self.bodies:
+            self.get_subrevision_body(subrev_num)
     def find_latest_file_rev_num(self):
-        files = os.listdir('.')
-        suffixes = [self.session_suffix, '.cog.json', '.ctx']
-        pattern = re.compile(rf'{re.escape(self.session_name)}\.(\d+)(?:{re.escape(self.session_suffix)}|\.cog\.json|\.ctx)')
-        max_rev = 0
-        for file in files:
-            for suffix in suffixes:
-                if file.endswith(suffix):
-                    match = re.match(rf'{re.escape(self.session_name)}\.(\d+)', file)
-                    if match:
-                        rev_num = int(match.group(1))
-                        max_rev = max(max_rev, rev_num)
-        return max_rev
+        return self.manifest.max_rev
     def increment_rev(self):
-        self.rev_num = self.find_latest_file_rev_num() + 1
+        self.rev_num = self.manifest.next_rev()
         self.cog_filename = f'{self.session_name}.{self.rev_num}.cog.json'
         self.edit_filename = f'{self.session_name}.{self.rev_num}{self.session_suffix}'
         self.ctx_filename = f'{self.session_name}.{self.rev_num}.ctx'
     def write_file(self, viewpoint, edit_window_content, command_window_content):
+        # Only snapshots are taken here; the file text, the original as revision 0 and the store
+        # records are all read and encoded on the writer thread.  Failures show up in the status
+        # line through writer.take_error(), and the next save simply tries again.
         self.increment_rev()
         self.store_revision(self.rev_num, edit_window_content)
-        if os.path.exists(self.original_filename):
-            os.rename(self.original_filename, self.edit_filename + ".org")
+        text = self.revisions[self.rev_num]
+        if not self.store.keys('rev') and os.path.exists(self.original_filename):
+            self.store.put_revision(0, self.read_original_lines, [])
+        self.store.put_revision(self.rev_num, text, command_window_content)
+        writer.replace(self.original_filename, lambda: "".join(line + '\n' for line in text))
+        for line_num, line in enumerate(command_window_content, start=1):
+            self.write_ctx_file_line(line, line_num, viewpoint, 'Write')
+        self.manifest.record_ctx(self.rev_num, self.ctx_filename)
+        writer.append(self.ctx_filename, f"[Context Summary] {self.ctx_summary}\n")
+        writer.save_point()
+        return "wrote"
+    def read_original_lines(self):
         try:
-            with open(self.original_filename, 'w') as og:
-                for line in edit_window_content:
-                    og.write(line + '\n')
-            with open(self.edit_filename, 'w') as f:
-                for line in edit_window_content:
-                    f.write(line + '\n')
-            with open(self.ctx_filename, 'a') as ctxf:
-                for line_num, line in enumerate(command_window_content, start=1):
-                    self.write_ctx_file_line(line, line_num, viewpoint, 'Write')
-                ctxf.write(f"[Context Summary] {self.ctx_summary}\n")
-        except Exception as e:
-            return "no wr"
-        finally:
-            return "wrote"
+            with open(self.original_filename, 'r') as og:
+                return [line.rstrip('\n') for line in og]
+        except OSError:
+            return []
     def read_file(self):
+        writer.wait_for(self.original_filename)
         try:
+            if os.path.getsize(self.original_filename) >= args.mmap_threshold << 20:
+                return "mmap ", LineBuffer.mapped(self.original_filename)
             with open(self.original_filename, 'r') as og:
                 lines = [line.rstrip('\n') for line in og]
             return "read ", lines
@@ -313,19 +1969,30 @@ class EditRevisionManager:
             elif isinstance(e, IsADirectoryError):
                 return "dir  "
     def write_ctx_file_line(self, line, line_num, viewpoint, action):
-            with open(self.ctx_filename, 'a') as ctxf:
-                ctxf.write(f"{line_num:03}<[{viewpoint.get_current_name()}][{action}]{line}\n")
-    def update_ctx_summary(self, viewpoints):
-            if 'Inline' in viewpoints.get_textops():
-                return
-            ctx_entries = self.ctx_subrev_entries()
-            if not ctx_entries or len(ctx_entries) < 3:
-                return
-            self.cogengine.reset_viewpoint(viewpoints, 'Ctx Summary')
-            self.cogengine.add_usermsg(ctx_entries)
-            self.cogengine.save_cogtext()
-            reform = self.cogengine.ai_query(viewpoints)
-            self.ctx_summary = reform.choices[0].message.content[:64]
+            self.manifest.record_ctx(self.rev_num, self.ctx_filename)
+            writer.append(self.ctx_filename, f"{line_num:03}<[{viewpoint.get_current_name()}][{action}]{line}\n")
+    def schedule_ctx_summary(self, delay=CTX_SUMMARY_DELAY):
+        # Debounced: each new reply pushes the summary back, so a burst of queries is summarized once.
+        self.ctx_summary_due = time.monotonic() + delay
+    def ctx_summary_ready(self):
+        return self.ctx_summary_due is not None and time.monotonic() >= self.ctx_summary_due
+    def ctx_summary_messages(self, viewpoints):
+        # The summary so far and only the ctx lines added since it was made; None when nothing is new.
+        # Returns the messages and the subrevision the summary will then cover.
+        self.ctx_summary_due = None
+        ctx_entries, upto, lines = self.ctx_subrev_entries(self.ctx_folded)
+        if len(ctx_entries) < 3:
+            return None
+        messages = [{"role": "system", "content": attribute} for attribute in viewpoints.get_attributes_by_name('Ctx Summary')]
+        if self.ctx_folded:
+            messages.append({"role": "system", "content": f"The summary so far: {self.ctx_summary}  Update it with the new entries."})
+        messages.append({"role": "user", "content": ctx_entries})
+        return messages, upto, lines
+    def fold_ctx_summary(self, summary, upto, lines):
+        if upto > self.ctx_folded:
+            self.ctx_summary = summary[:64]
+            self.ctx_folded = upto
+            self.ctx_folded_lines = lines
     def get_revision_display(self, viewpoints):
         subrevision = self.subrevisions.get(self.subrev_being_viewed, {})
         subrev_type = subrevision.get("type", "Session")
@@ -339,27 +2006,227 @@ class EditRevisionManager:
             if subrevision.get("type") == "Markup":
                 if subrev_num > highest_subrev_num:
                     highest_subrev_num = subrev_num
-                    subrev_text = subrevision.get("text")
+        if highest_subrev_num >= 0:
+            body = self.get_subrevision_body(highest_subrev_num)
+            subrev_text = body["text"] if body else None
         self.subrev_being_viewed = highest_subrev_num
         return subrev_text
-    def ctx_subrev_entries(self):
+    def ctx_subrev_entries(self, after=0):
+            # ctx lines of the subrevisions after the given one that were not already in the ctx
+            # before them, grouped by subrevision type.
             ctx_entries = {}
+            upto = after
+            seen = set(self.ctx_folded_lines if after == self.ctx_folded else ())
+            lines = ()
             for subrev_num, subrev in self.subrevisions.items():
+                if subrev_num <= after:
+                    continue
                 subrev_type = subrev.get("type", "unknown")
                 if subrev_type not in ctx_entries:
                     ctx_entries[subrev_type] = []
-                if 'ctx' in subrev:
-                    ctx_entries[subrev_type].extend(subrev['ctx'])
+                body = self.get_subrevision_body(subrev_num, keep=False)
+                if body:
+                    lines = tuple(body['ctx'])
+                    ctx_entries[subrev_type].extend(line for line in lines if line not in seen)
+                    seen = set(lines)
+                upto = subrev_num
             ctx_entries_str = ""
             for subrev_type, entries in ctx_entries.items():
-                ctx_entries_str += f"Subrevision Type: {subrev_type}\n"
-                ctx_entries_str += "\n".join(entries) + "\n"
-            return ctx_entries_str
+                if entries:
+                    ctx_entries_str += f"Subrevision Type: {subrev_type}\n"
+                    ctx_entries_str += "\n".join(entries) + "\n"
+            return ctx_entries_str, upto, lines
+
+class AIRequest:
+    def __init__(self, kind, viewpoints, messages, window):
+        self.request_id = 0
+        self.kind = kind
+        self.viewpoint = viewpoints.get_current_name()
+        self.model = viewpoints.get_model()
+        self.max_tokens = viewpoints.get_maxtokens()
+        self.prompt_budget = viewpoints.get_prompt_budget()
+        self.tokens = None
+        self.packing = None
+        self.parts = None
+        self.textops = list(viewpoints.get_textops())
+        self.stream = viewpoints.get_stream() and kind == 'query'
+        self.priority = 0 if kind == 'query' else 1
+        self.use_cache = viewpoints.get_cache()
+        self.messages = messages
+        self.window = window
+        self.line_num = 0
+        self.line_text = None
+        self.keys_handled = 0
+        self.status = 'queued'
+        self.content = []
+        self.ttft = None
+        self.cancelled = threading.Event()
+    def describe(self):
+        name = 'sumry' if self.kind == 'summary' else self.viewpoint[:5]
+        if self.status == 'streaming':
+            return f"#{self.request_id} {name} {sum(len(piece) for piece in self.content)}ch"
+        if self.parts is not None:
+            return f"#{self.request_id} {name} {sum(part is not None for part in self.parts)}/{len(self.parts)}"
+        if self.tokens is not None:
+            trimmed = '!' if self.tokens.over else '~' if self.tokens.dropped or self.tokens.elided else ''
+            packed = f" code {self.packing.tokens}/{self.packing.full_tokens}t" if self.packing else ''
+            return f"#{self.request_id} {name} {self.status} {self.tokens.prompt}{trimmed}+{self.max_tokens}t{packed}"
+        return f"#{self.request_id} {name} {self.status}"
+
+class AIQueryWorker:
+    # AI requests are queued to a small pool of threads; the curses loop polls the results queue
+    # between keystrokes, so only the main thread ever touches the windows.  A request for a long
+    # document can be sent as chunks: they share the pool, a failed chunk alone is retried, and
+    # the replies are stitched back in order once every chunk is in.
+    RETRIES = 2
+    def __init__(self, cogengine, workers=3):
+        self.cogengine = cogengine
+        self.requests = queue.PriorityQueue()
+        self.results = queue.Queue()
+        self.queued = 0
+        self.inflight = {}
+        self.next_id = 1
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+    def submit(self, request, chunks=None):
+        # chunks are (joiner, messages) pairs; each chunk's reply joins the one before with its joiner.
+        request.request_id = self.next_id
+        self.next_id += 1
+        request.messages, request.tokens = self.cogengine.budget.fit(request.messages, request.prompt_budget, request.model)
+        self.inflight[request.request_id] = request
+        if not chunks:
+            self.enqueue(request)
+            return request
+        request.parts = [None] * len(chunks)
+        request.joiners = [joiner for joiner, _ in chunks]
+        request.stream = False
+        for index, (_, messages) in enumerate(chunks):
+            chunk = copy.copy(request)
+            chunk.parent = request
+            chunk.index = index
+            chunk.attempts = 0
+            chunk.messages = self.cogengine.budget.fit(messages, request.prompt_budget, request.model)[0]
+            self.enqueue(chunk)
+        return request
+    def enqueue(self, request):
+        # Queries go ahead of background work such as summaries, first come first served within each.
+        self.queued += 1
+        self.requests.put((request.priority, self.queued, request))
+    def work(self):
+        while True:
+            request = self.requests.get()[2]
+            if request.cancelled.is_set():
+                self.results.put(('cancelled', request, None))
+                continue
+            request.status = 'sent'
+            try:
+                on_delta = (lambda delta, request=request: self.results.put(('delta', request, delta))) if request.stream else None
+                reform, request.ttft = self.cogengine.complete(request.model, request.max_tokens, request.messages, on_delta, request.cancelled.is_set, request.use_cache)
+                if reform is None or request.cancelled.is_set():
+                    self.results.put(('cancelled', request, None))
+                else:
+                    self.results.put(('done', request, reform))
+            except Exception as e:
+                self.results.put(('error', request, e))
+    def poll(self):
+        events = []
+        while True:
+            try:
+                event, request, payload = self.results.get_nowait()
+            except queue.Empty:
+                return events
+            parent = getattr(request, 'parent', None)
+            if parent is None:
+                events.append((event, request, payload))
+            elif parent.request_id in self.inflight:
+                self.chunk_event(events, event, request, parent, payload)
+    def chunk_event(self, events, event, chunk, request, payload):
+        if event == 'error' and chunk.attempts < self.RETRIES:
+            chunk.attempts += 1
+            self.enqueue(chunk)
+        elif event != 'done':
+            request.cancelled.set()
+            self.finish(request)
+            events.append((event, request, payload))
+        else:
+            request.parts[chunk.index] = payload.choices[0].message.content
+            if request.ttft is None:
+                request.ttft = chunk.ttft
+            request.status = 'sent'
+            if all(part is not None for part in request.parts):
+                self.finish(request)
+                joined = [request.parts[0].rstrip('\n')]
+                for joiner, part in zip(request.joiners[1:], request.parts[1:]):
+                    joined += [joiner, part.rstrip('\n')]
+                events.append(('done', request, CogReply(''.join(joined))))
+    def finish(self, request):
+        self.inflight.pop(request.request_id, None)
+    def cancel_latest(self):
+        for request in reversed(list(self.inflight.values())):
+            if request.kind == 'query' and not request.cancelled.is_set():
+                request.cancelled.set()
+                request.status = 'cancl'
+                return request
+        return None
+    def preview(self, window):
+        streaming = [request for request in self.inflight.values() if request.window == window and request.content]
+        return streaming[-1] if streaming else None
+    def describe(self):
+        return "  ".join(f"[{request.describe()}]" for request in self.inflight.values())
+
+class FrameRenderer:
+    # Keeps a shadow copy of the last frame, as rows of (x, text, attr) runs, and only redraws
+    # the rows that changed.  Output is batched with noutrefresh/doupdate.
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.shadow = {}
+        self.full_repaint = True
+        self.frame_calls = 0
+        self.total_calls = 0
+        self.frames = 0
+    def invalidate(self):
+        self.full_repaint = True
+    def call(self, func, *args):
+        self.frame_calls += 1
+        try:
+            func(*args)
+        except curses.error:
+            pass
+    def clear_row(self, y):
+        self.call(self.stdscr.move, y, 0)
+        self.call(self.stdscr.clrtoeol)
+    def render(self, rows, cursor=None):
+        self.frame_calls = 0
+        if self.full_repaint:
+            self.call(self.stdscr.erase)
+            self.shadow = {}
+            self.full_repaint = False
+        for y in self.shadow.keys() - rows.keys():
+            self.clear_row(y)
+        for y, runs in rows.items():
+            if self.shadow.get(y) == runs:
+                continue
+            self.clear_row(y)
+            for x, text, attr in runs:
+                self.call(self.stdscr.addstr, y, x, text, attr)
+        self.shadow = rows
+        if cursor:
+            self.call(self.stdscr.move, *cursor)
+        self.call(self.stdscr.noutrefresh)
+        self.call(curses.doupdate)
+        self.frames += 1
+        self.total_calls += self.frame_calls
 
 class AIQuickKeyEditor:
+    PASTE_START = [27, ord('['), ord('2'), ord('0'), ord('0'), ord('~')]
+    PASTE_END = [27, ord('['), ord('2'), ord('0'), ord('1'), ord('~')]
+    PASTE_WAIT = 200
+    typing_keys = (ord('\n'), 127, curses.KEY_BACKSPACE, curses.KEY_DC)
     def __init__(self, stdscr):
         signal.signal(signal.SIGINT, self.handle_sigint)
+        self.interrupted = False
         self.stdscr = stdscr
+        self.renderer = FrameRenderer(stdscr)
         self.mode = 'line'
         self.status = 'hello'
         self.clipboard = []
@@ -371,8 +2238,8 @@ class AIQuickKeyEditor:
         self.search_results = []
         self.current_search_result = -1
         self.windows = [
-            {"line_num": 0, "col_num": 0, "text": [""]},
-            {"line_num": 0, "col_num": 0, "text": [""]},
+            {"line_num": 0, "col_num": 0, "text": LineBuffer([""])},
+            {"line_num": 0, "col_num": 0, "text": LineBuffer([""])},
         ]
         self.window_offsets = [0, 0]
         self.screen_height, self.screen_width = self.stdscr.getmaxyx()
@@ -380,8 +2247,17 @@ class AIQuickKeyEditor:
         self.top_window_size = self.screen_height - self.bottom_window_size - 1
         self.viewpoints = Viewpoints()
         self.personalchoice = self.viewpoints.get_current_name()
-        self.context = CogEngine(self.viewpoints)
+        self.context = CogEngine(self.viewpoints, ResponseCache(args.cache))
         self.revision_manager = EditRevisionManager(args.session, self.context)
+        self.ai_worker = AIQueryWorker(self.context, args.ai_workers)
+        self.symbol_index = SymbolIndex(self.windows[0]["text"])
+        self.code_packer = ContextPacker(self.windows[0]["text"])
+        self.undo_logs = [UndoLog(window["text"], lambda window=window: (window["line_num"], window["col_num"]), lambda buffer, index=index: self.set_window_text(index, buffer)) for index, window in enumerate(self.windows)]
+        self.undo_toggled = False
+        self.patch_engine = PatchEngine()
+        self.sparse_corrector = SparseCorrector()
+        self.spell_index = SpellIndex.open(args.words) if args.words else None
+        self.keys_handled = 0
         self.keymap = {
             curses.KEY_UP: self.handle_up_arrow,
             curses.KEY_DOWN: self.handle_down_arrow,
@@ -410,15 +2286,18 @@ class AIQuickKeyEditor:
             8: self.handle_ctrl_h,
             7: self.handle_ctrl_g,
             14: self.handle_ctrl_n,
-            #21: self.handle_ctrl_u
+            21: self.handle_undo,
+            15: self.handle_redo,
             5: self.handle_ctrl_e,
             17: self.handle_ctrl_q,
-            19: self.handle_ctrl_s
+            19: self.handle_ctrl_s,
+            27: self.handle_escape
             #43: self.increase_top_window_size,
             #45: self.decrease_top_window_size,
         }
         if os.path.exists(args.session):
             self.read_file(args.session)
+            self.undo_logs[0].reset()
         else:
             self.show_splash_screen()
     def handle_return(self):
@@ -426,8 +2305,7 @@ class AIQuickKeyEditor:
         line = current_window["text"][current_window["line_num"]]
         self.context.add_cogtext("user", line)
         self.context.add_usermsg(line)
-        current_window["text"].insert(current_window["line_num"] + 1, current_window["text"][current_window["line_num"]][current_window["col_num"]:])
-        current_window["text"][current_window["line_num"]] = current_window["text"][current_window["line_num"]][:current_window["col_num"]]
+        current_window["text"].split_line(current_window["line_num"], current_window["col_num"])
         current_window["line_num"] += 1
         current_window["col_num"] = 0
         self.adjust_window_offset()
@@ -436,65 +2314,59 @@ class AIQuickKeyEditor:
             if self.status != "":
                 modeOrStatus = self.status
                 self.status = ""
-            top_window = self.windows[0]["text"]
-            bottom_window = self.windows[1]["text"]
-            self.stdscr.clear()
-            for y in range(min(self.top_window_size, len(top_window) - self.window_offsets[0])):
-                line = top_window[y + self.window_offsets[0]]
-                line = line[:self.screen_width]
-                highlight = curses.A_UNDERLINE if self.context_window == 0 and y + self.window_offsets[0] in self.yanked_lines else curses.A_NORMAL
-                try:
-                    if self.show_left_column:
-                        self.stdscr.addstr(y, 0, f"{((y + self.window_offsets[0]+1)%1000):03}<{modeOrStatus:5}>", highlight | curses.A_REVERSE | (curses.A_BOLD if (self.context_window == 0 and y + self.window_offsets[0] == self.windows[0]["line_num"]) else 0))
-                        start_text_pos = len(f"{((y + self.window_offsets[0]+1)%1000):03}<{modeOrStatus:5}>")
-                    else:
-                        start_text_pos = 0
-                    if self.context_window == 0 and y + self.window_offsets[0] == self.windows[0]["line_num"]:
-                        for x, ch in enumerate(line):
-                            if x == self.windows[0]["col_num"]:
-                                self.stdscr.addch(y, start_text_pos + x, ch, curses.A_REVERSE | curses.A_NORMAL)
-                            else:
-                                self.stdscr.addch(y, start_text_pos + x, ch, curses.A_BOLD)
-                        if self.windows[0]["col_num"] == len(line):
-                            self.stdscr.addch(y, start_text_pos + self.windows[0]["col_num"], ' ', curses.A_REVERSE | curses.A_NORMAL)
-                        if self.context_window == 0:
-                            self.stdscr.move(y, start_text_pos + self.windows[0]["col_num"])
-                    else:
-                        self.stdscr.addstr(y, start_text_pos, line)
-                except curses.error:
-                    pass
-            for y in range(self.top_window_size, self.top_window_size + self.bottom_window_size):
-                if y - self.top_window_size >= len(bottom_window) - self.window_offsets[1]:
-                    break
-                highlight = curses.A_UNDERLINE if self.context_window == 1 and y - self.top_window_size + self.window_offsets[1] in self.yanked_lines else curses.A_NORMAL
-                line = bottom_window[y - self.top_window_size + self.window_offsets[1]]
-                line = line[:self.screen_width]
-                try:
-                    if self.show_left_column:
-                        self.stdscr.addstr(y, 0, f"{((y - self.top_window_size + self.window_offsets[1]+1)%1000):03}<{self.viewpoints.get_current_name():5}>", highlight | curses.A_REVERSE | (curses.A_BOLD if (self.context_window == 1 and y - self.top_window_size + self.window_offsets[1] == self.windows[1]["line_num"]) else 0))
-                        start_text_pos = len(f"{((y - self.top_window_size + self.window_offsets[1]+1)%1000):03}<{self.viewpoints.get_current_name():5}>")
-                    else:
-                        start_text_pos = 0
-                    if self.context_window == 1 and y - self.top_window_size + self.window_offsets[1] == self.windows[1]["line_num"]:
-                        for x, ch in enumerate(line):
-                            if x == self.windows[1]["col_num"]:
-                                self.stdscr.addch(y, start_text_pos + x, ch, curses.A_REVERSE | curses.A_NORMAL)
-                            else:
-                                self.stdscr.addch(y, start_text_pos + x, ch, curses.A_BOLD)
-                        if self.windows[1]["col_num"] == len(line):
-                            self.stdscr.addch(y, start_text_pos + self.windows[1]["col_num"], ' ', curses.A_REVERSE | curses.A_NORMAL)
-                        if self.context_window == 1:
-                            self.stdscr.move(y, start_text_pos + self.windows[1]["col_num"])
-                    else:
-                        self.stdscr.addstr(y, start_text_pos, line)
-                except curses.error:
-                    pass
+            rows = {}
+            top_cursor = self.compose_window_rows(0, 0, self.top_window_size, modeOrStatus, rows)
+            bottom_cursor = self.compose_window_rows(1, self.top_window_size, self.bottom_window_size, self.viewpoints.get_current_name(), rows)
             summary_str = self.revision_manager.get_revision_display(self.viewpoints)
+            if self.ai_worker.inflight:
+                summary_str = f"{self.ai_worker.describe()}  {summary_str}"
+            if self.context.ttft is not None:
+                summary_str = f"[ttft {self.context.ttft:.2f}s]  {summary_str}"
+            if self.context.cache and self.context.cache.hits + self.context.cache.misses:
+                summary_str = f"[{self.context.cache.describe()}]  {summary_str}"
+            if self.spell_index and self.spell_index.lines_checked:
+                summary_str = f"[{self.spell_index.describe()}]  {summary_str}"
+            if self.windows[0]["text"].loading:
+                summary_str = f"[loading, {len(self.windows[0]['text'])} lines so far]  {summary_str}"
+            if args.render_stats:
+                summary_str = f"[{self.renderer.frame_calls:4} calls/frame]  {summary_str}"
             max_len = curses.COLS - 1
             if len(summary_str) > max_len:
                 summary_str = summary_str[:max_len]
-            self.stdscr.addstr(self.screen_height - 1, 0, summary_str)
-            self.stdscr.refresh()
+            rows[self.screen_height - 1] = ((0, summary_str, curses.A_NORMAL),)
+            self.renderer.render(rows, top_cursor if self.context_window == 0 else bottom_cursor)
+    def compose_window_rows(self, window_index, first_row, height, label, rows):
+        window = self.windows[window_index]
+        offset = self.window_offsets[window_index]
+        cursor = None
+        for y in range(min(height, len(window["text"]) - offset)):
+            line_index = y + offset
+            line = window["text"][line_index][:self.screen_width]
+            is_cursor_line = self.context_window == window_index and line_index == window["line_num"]
+            highlight = curses.A_UNDERLINE if self.context_window == window_index and line_index in self.yanked_lines else curses.A_NORMAL
+            runs = []
+            start_text_pos = 0
+            if self.show_left_column:
+                left_column = f"{((line_index+1)%1000):03}<{label:5}>"
+                runs.append((0, left_column, highlight | curses.A_REVERSE | (curses.A_BOLD if is_cursor_line else 0)))
+                start_text_pos = len(left_column)
+            if is_cursor_line:
+                col = window["col_num"]
+                runs.append((start_text_pos, line[:col], curses.A_BOLD))
+                runs.append((start_text_pos + col, line[col:col + 1] or ' ', curses.A_REVERSE | curses.A_NORMAL))
+                runs.append((start_text_pos + col + 1, line[col + 1:], curses.A_BOLD))
+                cursor = (first_row + y, start_text_pos + col)
+            else:
+                runs.append((start_text_pos, line, curses.A_NORMAL))
+            rows[first_row + y] = tuple(run for run in runs if run[1])
+        shown = max(0, min(height, len(window["text"]) - offset))
+        preview = self.ai_worker.preview(window_index)
+        if preview and shown < height:
+            preview_lines = [f"[{preview.viewpoint}][AI viewpoint][--Streaming #{preview.request_id}]"] + "".join(preview.content).split('\n')
+            start_text_pos = len(f"000<{label:5}>") if self.show_left_column else 0
+            for y, line in enumerate(preview_lines[-(height - shown):], start=shown):
+                rows[first_row + y] = ((start_text_pos, line[:self.screen_width], curses.A_DIM),)
+        return cursor
     def adjust_window_offset(self):
         for i in range(2):
             while self.windows[i]["line_num"] < self.window_offsets[i]:
@@ -513,46 +2385,39 @@ class AIQuickKeyEditor:
             self.adjust_window_offset()
     def insert_char(self, ch):
         current_window = self.windows[self.context_window]
-        line = current_window["text"][current_window["line_num"]]
         if ch in (curses.KEY_BACKSPACE, 127):
-            if current_window["col_num"] > 0:
-                current_window["text"][current_window["line_num"]] = line[:current_window["col_num"] - 1] + line[current_window["col_num"]:]
-                current_window["col_num"] -= 1
-            elif current_window["col_num"] == 0 and current_window["line_num"] > 0:
-                prev_line = current_window["text"][current_window["line_num"] - 1]
-                current_window["col_num"] = len(prev_line)
-                current_window["text"][current_window["line_num"] - 1] += current_window["text"].pop(current_window["line_num"])
-                current_window["line_num"] -= 1
+            current_window["line_num"], current_window["col_num"] = current_window["text"].backspace(current_window["line_num"], current_window["col_num"])
         elif 0 <= ch <= 0x10FFFF and chr(ch).isprintable():
             self.mode = 'edit'
-            current_window["text"][current_window["line_num"]] = line[:current_window["col_num"]] + chr(ch) + line[current_window["col_num"]:]
-            current_window["col_num"] += 1
+            current_window["line_num"], current_window["col_num"] = current_window["text"].insert_text(current_window["line_num"], current_window["col_num"], chr(ch))
         self.adjust_window_offset()
     def handle_backspace(self, ch):
         if self.mode == 'edit':
             self.insert_char(ch)
+        elif self.undo_toggled and self.undo_logs[self.context_window].redo_units:
+            # Outside edit mode Backspace flips between the latest change and the text before it.
+            self.handle_redo()
+            self.undo_toggled = False
         else:
-            current_window = self.windows[self.context_window]
-            if self.clipboard:
-                undo_content = list(current_window["text"])
-                current_window["text"].clear()
-                current_window["text"].extend(self.clipboard)
-                self.clipboard = undo_content
-                if self.status == 'undo':
-                    self.status = 'redo'
-                    self.display()
-                else:
-                    self.status = 'undo'
-                    self.display()
-                if current_window["line_num"] >= len(current_window["text"]):
-                    current_window["line_num"] = len(current_window["text"]) - 1
-                if current_window["line_num"] < 0:
-                    current_window["line_num"] = 0
-                if current_window["col_num"] > len(current_window["text"][current_window["line_num"]]):
-                    current_window["col_num"] = len(current_window["text"][current_window["line_num"]])
-                if current_window["col_num"] < 0:
-                    current_window["col_num"] = 0
-                self.adjust_window_offset()
+            self.handle_undo()
+            self.undo_toggled = self.status == 'undo'
+    def handle_undo(self):
+        self.restore_cursor(self.undo_logs[self.context_window].undo(), 'undo')
+    def handle_redo(self):
+        self.restore_cursor(self.undo_logs[self.context_window].redo(), 'redo')
+    def restore_cursor(self, cursor, status):
+        if cursor is None:
+            self.status = f'n{status}'
+            return
+        current_window = self.windows[self.context_window]
+        current_window["line_num"], current_window["col_num"] = cursor
+        self.clamp_cursor(self.context_window)
+        self.status = status
+        self.adjust_window_offset()
+    @contextmanager
+    def undo_unit(self, kind):
+        with self.undo_logs[0].unit(kind), self.undo_logs[1].unit(kind):
+            yield
     def handle_up_arrow(self):
         current_window = self.windows[self.context_window]
         if current_window["line_num"] > 0:
@@ -582,13 +2447,18 @@ class AIQuickKeyEditor:
                 if 'Coder' in self.viewpoints.get_role():
                     self.context_window = 0
                 self.context.reset(self.viewpoints)
+                packing = None
+                if self.spell_index and self.viewpoints.get_prefilter() and self.correct_line_locally():
+                    return
                 if self.viewpoints.test_textop('Inline'):
                     user_line = self.windows[self.context_window]["text"][self.windows[self.context_window]["line_num"]].strip()
                     self.context.add_cogtext("user", user_line)
                     self.revision_manager.write_ctx_file_line(user_line, self.windows[self.context_window]["line_num"], self.viewpoints, 'Query')
                 else:
                     self.write_file()
-                if self.context_window == 1:
+                if self.viewpoints.test_textop('Sparse'):
+                    self.context.add_cogtext("user", self.sparse_corrector.numbered(self.windows[self.context_window]["text"]))
+                elif self.context_window == 1:
                     if self.viewpoints.test_textop('Inline'):
                         user_line = self.windows[self.context_window]["text"][self.windows[self.context_window]["line_num"]].strip()
                         self.context.add_cogtext("user", user_line)
@@ -608,29 +2478,147 @@ class AIQuickKeyEditor:
                             if line.strip():
                                 userlines += line + '\n'
                         self.context.add_cogtext("system", userlines)
-                        userlines = ""
-                        for line in self.windows[0]["text"]:
-                            if line.strip():
-                                userlines += line + '\n'
-                        self.context.add_cogtext("user", userlines)
+                        packing = self.pack_code_context()
+                        if packing:
+                            if self.viewpoints.get_outline_note():
+                                self.context.add_cogtext("system", self.viewpoints.get_outline_note())
+                            self.context.add_cogtext("user", packing.text)
+                        else:
+                            userlines = ""
+                            for line in self.windows[0]["text"]:
+                                if line.strip():
+                                    userlines += line + '\n'
+                            self.context.add_cogtext("user", userlines)
                 self.context.save_cogtext()
-                self.clipboard = [line for line in self.windows[self.context_window]["text"]]
                 # I am a fluffy unicorn, with light green spots.
+                request = AIRequest('query', self.viewpoints, self.context.get_cogtext(), self.context_window)
+                request.line_num = self.windows[self.context_window]["line_num"]
+                request.line_text = self.windows[self.context_window]["text"][request.line_num]
+                request.keys_handled = self.keys_handled
+                request.packing = packing
+                self.ai_worker.submit(request, self.chunk_messages(request))
                 self.status = 'ai *'
-                self.display()
-                ai_revise = self.context.ai_query(self.viewpoints)
-                #self.context.save_cogtext()
-                self.apply_textops(ai_revise, self.viewpoints.get_textops())
-                self.mode = 'reply'
-                self.stdscr.nodelay(True)
-                try:
-                    ch = self.stdscr.getch()
-                    while ch != -1:
-                        ch = self.stdscr.getch()
-                finally:
-                    self.stdscr.nodelay(False)
-                self.revision_manager.update_ctx_summary(self.viewpoints)
-                self.adjust_window_offset()
+    def correct_line_locally(self):
+        # Lines whose only problems are clear typos are fixed from the spelling index, no AI needed.
+        window = self.windows[self.context_window]
+        check = self.spell_index.check_line(window["text"][window["line_num"]])
+        if check.escalate:
+            return False
+        self.revision_manager.write_ctx_file_line(check.text, window["line_num"], self.viewpoints, 'Local')
+        self.insert_as_current_line(check.text)
+        self.mode = 'reply'
+        self.status = 'local'
+        return True
+    def chunk_messages(self, request):
+        # Long documents go out as one request per chunk, each with the same instructions.  Replies
+        # rejoin with a blank line only where the split fell between paragraphs.
+        chunk_tokens = self.viewpoints.get_chunk_tokens()
+        if not chunk_tokens or request.messages[-1]["role"] != "user":
+            return None
+        text = self.windows[request.window]["text"]
+        spans = self.context.budget.chunk_lines(text, chunk_tokens, request.model)
+        if len(spans) < 2:
+            return None
+        chunks = []
+        for start, end in spans:
+            if 'Sparse' in request.textops:
+                content = self.sparse_corrector.numbered(text[start:end], start + 1)
+                joiner = '\n'
+            else:
+                content = ''.join(line + '\n' for line in text[start:end] if line.strip())
+                joiner = '\n\n' if start > 0 and not (text[start - 1].strip() and text[start].strip()) else '\n'
+            if content:
+                chunks.append((joiner, request.messages[:-1] + [{"role": "user", "content": content}]))
+        return chunks
+    def pack_code_context(self):
+        outline_over = self.viewpoints.get_outline_over()
+        if not outline_over or len(self.windows[0]["text"]) <= outline_over:
+            return None
+        return self.code_packer.pack(self.windows[0]["text"], self.windows[1]["text"], self.windows[0]["line_num"], self.context.budget, self.viewpoints.get_model())
+    def poll_writer(self):
+        error = writer.take_error()
+        if error:
+            self.status = 'wr er'
+            self.windows[1]["text"].append(f"[Writer error] {error}")
+    def poll_ai_results(self):
+        for event, request, payload in self.ai_worker.poll():
+            if event == 'delta':
+                request.content.append(payload)
+                request.status = 'streaming'
+                continue
+            self.ai_worker.finish(request)
+            if event == 'cancelled':
+                self.status = 'cancl'
+            elif event == 'error':
+                self.status = 'ai er'
+                self.windows[1]["text"].append(f"[{request.viewpoint}][AI error #{request.request_id}] {payload}")
+            elif request.kind == 'summary':
+                self.revision_manager.fold_ctx_summary(payload.choices[0].message.content, *request.covers)
+                self.status = 'sumry'
+            else:
+                self.context.ttft = request.ttft
+                self.merge_ai_reply(request, payload)
+    def merge_ai_reply(self, request, ai_revise):
+        with self.undo_unit('reply'):
+            self.merge_reply_text(request, ai_revise)
+    def merge_reply_text(self, request, ai_revise):
+        # Replies merge into the window they were asked from.  If the user kept typing meanwhile the
+        # cursor stays put, and an Inline reply whose line has since changed lands as a subrevision.
+        window = self.windows[request.window]
+        user_window = self.context_window
+        user_cursor = (window["line_num"], window["col_num"])
+        typed = self.keys_handled != request.keys_handled
+        with self.viewpoints.pinned(request.viewpoint):
+            self.context_window = request.window
+            line_num = self.find_request_line(request) if 'Inline' in request.textops else window["line_num"]
+            if line_num is None:
+                self.revision_manager.store_subrevision(self.windows[0]["text"], ai_revise.choices[0].message.content.split('\n'), "Inline")
+                self.status = 'subrv'
+            else:
+                window["line_num"] = line_num
+                self.apply_textops(ai_revise, request.textops)
+                self.status = 'reply'
+                self.request_ctx_summary()
+        self.context_window = user_window
+        window = self.windows[request.window]
+        if typed:
+            window["line_num"], window["col_num"] = user_cursor
+            self.clamp_cursor(request.window)
+        else:
+            self.mode = 'reply'
+        self.adjust_window_offset()
+    def find_request_line(self, request):
+        text = self.windows[request.window]["text"]
+        if request.line_num < len(text) and text[request.line_num] == request.line_text:
+            return request.line_num
+        for line_num, line in enumerate(text):
+            if line == request.line_text:
+                return line_num
+        return None
+    def request_ctx_summary(self):
+        if 'Inline' not in self.viewpoints.get_textops():
+            self.revision_manager.schedule_ctx_summary()
+    def start_ctx_summary(self):
+        # Run from the main loop once the debounce delay has passed and no summary is in flight.
+        if not self.revision_manager.ctx_summary_ready():
+            return
+        if any(request.kind == 'summary' for request in self.ai_worker.inflight.values()):
+            return
+        summary = self.revision_manager.ctx_summary_messages(self.viewpoints)
+        if summary is None:
+            return
+        messages, upto, lines = summary
+        with self.viewpoints.pinned('Ctx Summary'):
+            request = AIRequest('summary', self.viewpoints, messages, None)
+        request.covers = (upto, lines)
+        self.ai_worker.submit(request)
+    def clamp_cursor(self, window_index):
+        window = self.windows[window_index]
+        window["line_num"] = max(0, min(window["line_num"], len(window["text"]) - 1))
+        window["col_num"] = max(0, min(window["col_num"], len(window["text"][window["line_num"]])))
+    def handle_escape(self):
+        if self.ai_worker.cancel_latest():
+            self.status = 'cancl'
     def apply_textops(self, ai_revise, textops):
         response_text = ai_revise.choices[0].message.content.split('\n')
         if 'Inline' in textops:
@@ -639,7 +2627,11 @@ class AIQuickKeyEditor:
             self.insert_as_current_line(response_text[0])
         else:
             self.revision_manager.store_subrevision(self.windows[0]["text"], self.windows[1]["text"], "Original")
-        if 'Coder' in self.viewpoints.get_role():
+        if 'Patch' in textops:
+            self.apply_patch_reply(ai_revise.choices[0].message.content)
+        elif 'Sparse' in textops:
+            self.apply_sparse_reply(ai_revise.choices[0].message.content)
+        elif 'Coder' in self.viewpoints.get_role():
             objs = self.context.extract_objects(ai_revise.choices[0].message.content)
             #for obj in objs:
             #    self.windows[1]["text"].extend({obj['name']})
@@ -660,7 +2652,7 @@ class AIQuickKeyEditor:
                 if not found:
                     self.windows[0]["line_num"] = 0
                     self.windows[0]["col_num"] = 0
-                self.windows[0]["text"] = sub_text
+                self.set_window_text(0, sub_text)
                 if self.windows[0]["line_num"] >= len(self.windows[0]["text"]):
                     self.windows[0]["line_num"] = len(self.windows[0]["text"]) - 1
                 if self.windows[0]["line_num"] < 0:
@@ -672,8 +2664,8 @@ class AIQuickKeyEditor:
                 self.search_offset()
                 self.adjust_window_offset()
         elif 'replace' in textops:
-            self.revision_manager.store_subrevision(response_text, self.windows[1]["text"], "replace")
-            self.windows[self.context_window]["text"] = response_text
+            response_text = self.revision_manager.store_subrevision(response_text, self.windows[1]["text"], "replace")
+            self.set_window_text(self.context_window, response_text)
         elif 'Concatenate' in textops:
             bline = len(self.windows[self.context_window]["text"])
             self.windows[self.context_window]["line_num"] = bline
@@ -686,104 +2678,63 @@ class AIQuickKeyEditor:
             self.insert_lines_at_current_line(" ")
             self.insert_lines_at_current_line("'''")
             self.windows[self.context_window]["line_num"] = bline
+    def apply_sparse_reply(self, content):
+        window = self.windows[self.context_window]
+        cursor = (window["line_num"], window["col_num"])
+        applied, rejected, cursor = self.sparse_corrector.apply(window["text"], self.sparse_corrector.parse(content), cursor)
+        window["line_num"], window["col_num"] = cursor
+        if rejected:
+            self.windows[1]["text"].append(f"[{self.viewpoints.get_current_name()}][Sparse] {rejected} of {applied + rejected} corrections did not match the text")
+        if applied and self.context_window == 0:
+            self.revision_manager.store_subrevision(self.windows[0]["text"], self.windows[1]["text"], "Sparse")
+    def apply_patch_reply(self, content):
+        patched, results = self.patch_engine.apply(self.windows[0]["text"], self.patch_engine.parse(content))
+        for result in results:
+            if result.status == 'conflict':
+                self.windows[1]["text"].append(f"[{self.viewpoints.get_current_name()}][Patch conflict] hunk {result.number}: {result.reason}")
+        applied = [result for result in results if result.status != 'conflict']
+        if not applied:
+            return
+        patched = self.revision_manager.store_subrevision(patched, self.windows[1]["text"], "Patch")
+        self.revision_manager.subrev_being_viewed = self.revision_manager.subrev_num
+        self.set_window_text(0, patched)
+        self.windows[0]["line_num"] = min(result.line for result in applied)
+        self.windows[0]["col_num"] = 0
+        self.clamp_cursor(0)
+        self.adjust_window_offset()
     def refactor_edit_window(self, response_text, objects, textops):
-                top_window_copy = self.windows[0]["text"][:]
-                if 'Refactor' in textops or 'Deprecate' in textops:
-                    for function in objects:
-                        func_name = function['name']
-                        func_code = function['code']
-                        object_name = function.get('object', None)
-                        matched_class = None
-                        insert_pos = None
-                        end_pos = None
-                        for x, line in enumerate(top_window_copy):
-                            if object_name and line.strip().startswith(f"class {object_name}"):
-                                matched_class = object_name
-                            if matched_class == object_name and func_name in line and re.match(r'^\s*def\b', line):
-                                indent_level = len(line) - len(line.lstrip())
-                                indent = ' ' * indent_level
-                                insert_pos = x
-                                for y, end_line in enumerate(top_window_copy[x+1:], start=x+1):
-                                    if re.match(r'^\s*(def|class)\b', end_line):
-                                        end_pos = y
-                                        break
-                                if end_pos is None:
-                                    end_pos = len(top_window_copy)
-                                commented_code = [f"{indent}''' [{self.viewpoints.get_current_name()} --Deprecate][{object_name}::{func_name}][Rev:{self.revision_manager.rev_num} Sub:{self.revision_manager.subrev_num+1}][Type: Deprecate]"] + [l for l in top_window_copy[insert_pos:end_pos]] + [f"{indent}'''"]
-                                refactored_code = []
-                                if 'Deprecate' in textops:
-                                    refactored_code = [f"{indent}# [{self.viewpoints.get_current_name()} --Refactor][{object_name}::{func_name}][Rev:{self.revision_manager.rev_num} Sub:{self.revision_manager.subrev_num+1}][Type: Deprecate]\n"]
-                                for l in func_code.split('\n'):
-                                    if 'def' in l:
-                                        refactored_code += [indent + l]
-                                    else:
-                                        refactored_code += [l]
-                                if 'Deprecate' in textops:
-                                    top_window_copy = (
-                                        top_window_copy[:insert_pos] +
-                                        commented_code + refactored_code +
-                                        top_window_copy[end_pos:]
-                                    )
-                                if 'Refactor' in textops:
-                                    top_window_copy = (
-                                        top_window_copy[:insert_pos] +
-                                        refactored_code +
-                                        top_window_copy[end_pos:]
-                                    )
-                                break
-                        #if insert_pos is None and not object_name:
-                        #    indent = ' ' * 4
-                        #    new_code = ""
-                        #    new_code += [indent + l for l in func_code.split('\n')]
-                        #    top_window_copy.extend([f"\n''' [{self.viewpoints.get_current_name()}[--new]\n'''", new_code, ""])
-                if 'Markup' in textops:
-                    for function in objects:
-                        func_name = function['name']
-                        func_code = function['code']
-                        object_name = function.get('object', None)
-                        matched_class = None
-                        insert_pos = None
-                        end_pos = None
-                        for x, line in enumerate(top_window_copy):
-                            if object_name and line.strip().startswith(f"class {object_name}"):
-                                matched_class = object_name
-                            if matched_class == object_name and func_name in line and re.match(r'^\s*def\b', line):
-                                indent_level = len(line) - len(line.lstrip())
-                                indent = ' ' * indent_level
-                                insert_pos = x
-                                for y, end_line in enumerate(top_window_copy[x+1:], start=x+1):
-                                    if re.match(r'^\s*(def|class)\b', end_line):
-                                        end_pos = y
-                                        break
-                                if end_pos is None:
-                                    end_pos = len(top_window_copy)
-                                org_code =  [l for l in top_window_copy[insert_pos:end_pos]]
-                                refactored_code = []
-                                refactored_code = [f"{indent}''' [{self.viewpoints.get_current_name()} --Refactor][{object_name}::{func_name}][Rev:{self.revision_manager.rev_num} Sub:{self.revision_manager.subrev_num+1}][Type: Markup]\n"]
-                                for l in func_code.split('\n'):
-                                    if 'def' in l:
-                                        refactored_code += [indent + l]
-                                    else:
-                                        refactored_code += [l]
-                                refactored_code += [f"{indent}'''"]
-                                refactored_code += [f"\n"]
-                                top_window_copy = (
-                                    top_window_copy[:insert_pos] +
-                                    org_code + refactored_code +
-                                    top_window_copy[end_pos:]
-                                )
-                                break
-                        #if insert_pos is None and not object_name:
-                        #    indent = ' ' * 4
-                        #    new_code = ""
-                        #    new_code += [indent + l for l in func_code.split('\n')]
-                        #    top_window_copy.extend([f"\n''' [{self.viewpoints.get_current_name()}[--new]\n'''", new_code, ""])
-                    top_window_copy.append(f"'''")
-                    top_window_copy.append(f"[{self.viewpoints.get_current_name()}][--Concatenate][Rev: {self.revision_manager.rev_num}][Sub_rev: {self.revision_manager.subrev_num+1}]")
-                    top_window_copy.extend(response_text)
-                    top_window_copy.append(f"'''")
-                    top_window_copy.append(f"")
-                elif 'Concatenate' in textops:
+                # Targets come from the symbol index; every patch is collected first, then spliced,
+                # last first, into a buffer opened on a snapshot of the edit window, so the
+                # subrevision shares every untouched leaf with it.
+                top_window_text = self.windows[0]["text"]
+                label = f"[Rev:{self.revision_manager.rev_num} Sub:{self.revision_manager.subrev_num+1}]"
+                patches = []
+                for function in objects:
+                    func_name = function['name']
+                    func_code = function['code']
+                    object_name = function.get('object', None)
+                    span = self.symbol_index.lookup(object_name, func_name)
+                    if span is None:
+                        continue
+                    insert_pos, end_pos, indent = span
+                    if any(insert_pos < patch_end and patch_start < end_pos for patch_start, patch_end, _ in patches):
+                        continue
+                    org_code = top_window_text[insert_pos:end_pos]
+                    refactored_code = [indent + l if l.strip() else l for l in func_code.split('\n')]
+                    if 'Markup' in textops:
+                        replacement = org_code + [f"{indent}''' [{self.viewpoints.get_current_name()} --Refactor][{object_name}::{func_name}]{label}[Type: Markup]\n"] + refactored_code + [f"{indent}'''", f"\n"]
+                    elif 'Deprecate' in textops:
+                        commented_code = [f"{indent}''' [{self.viewpoints.get_current_name()} --Deprecate][{object_name}::{func_name}]{label}[Type: Deprecate]"] + org_code + [f"{indent}'''"]
+                        replacement = commented_code + [f"{indent}# [{self.viewpoints.get_current_name()} --Refactor][{object_name}::{func_name}]{label}[Type: Deprecate]\n"] + refactored_code
+                    elif 'Refactor' in textops:
+                        replacement = refactored_code
+                    else:
+                        continue
+                    patches.append((insert_pos, end_pos, replacement))
+                top_window_copy = LineBuffer(LineSnapshot.of(top_window_text))
+                for patch_start, patch_end, replacement in sorted(patches, key=itemgetter(0), reverse=True):
+                    top_window_copy.replace_lines(patch_start, patch_end, replacement)
+                if 'Markup' in textops or 'Concatenate' in textops:
                     top_window_copy.append(f"'''")
                     top_window_copy.append(f"[{self.viewpoints.get_current_name()}][--Concatenate][Rev: {self.revision_manager.rev_num}][Sub_rev: {self.revision_manager.subrev_num+1}]")
                     top_window_copy.extend(response_text)
@@ -793,7 +2744,16 @@ class AIQuickKeyEditor:
     def write_file(self):
         self.status = self.revision_manager.write_file(self.viewpoints, self.windows[0]["text"], self.windows[1]["text"])
     def read_file(self, filename):
-        self.status, self.windows[0]["text"] = self.revision_manager.read_file()
+        self.status, lines = self.revision_manager.read_file()
+        self.set_window_text(0, lines)
+    def set_window_text(self, window_index, lines):
+        buffer = lines if isinstance(lines, LineBuffer) else LineBuffer(lines)
+        self.undo_logs[window_index].swapped(self.windows[window_index]["text"], buffer)
+        self.windows[window_index]["text"] = buffer
+        self.undo_logs[window_index].attach(buffer)
+        if window_index == 0:
+            self.symbol_index.attach(self.windows[0]["text"])
+            self.code_packer.attach(self.windows[0]["text"])
     def delete_current_line(self):
         self.status = 'delln'
         current_window = self.windows[self.context_window]
@@ -808,7 +2768,7 @@ class AIQuickKeyEditor:
         else:
             line = current_window["text"][0]
             self.clipboard = [line]
-            current_window["text"] = [""]
+            self.set_window_text(self.context_window, [""])
             current_window["line_num"] = 0
             current_window["col_num"] = 0
         self.adjust_window_offset()
@@ -839,14 +2799,9 @@ class AIQuickKeyEditor:
     def handle_ctrl_p(self):
         if self.clipboard:
             current_window = self.windows[self.context_window]
-            buffer = list(current_window["text"])
             current_line = current_window["text"][current_window["line_num"]]
-            for line in self.clipboard:
-                current_window["text"].insert(current_window["line_num"], line)
-                current_window["line_num"] += 1
+            current_window["line_num"] = current_window["text"].insert_lines(current_window["line_num"], self.clipboard)
             current_window["col_num"] = len(current_line)
-            self.clipboard = []
-            self.clipboard = buffer
             self.mode = 'line'
             self.status = 'paste'
             self.adjust_window_offset()
@@ -920,17 +2875,11 @@ class AIQuickKeyEditor:
         current_window = self.windows[self.context_window]
         current_line_index = current_window["line_num"]
         current_column_index = current_window["col_num"]
-        first_line = current_window["text"][current_line_index] if current_line_index < len(current_window["text"]) else ""
-        new_first_line = first_line[:current_column_index] + lines[0]
-        if current_column_index < len(first_line):
-            new_first_line += first_line[current_column_index:]
-        if current_line_index < len(current_window["text"]):
-            current_window["text"][current_line_index] = new_first_line
-        else:
-            current_window["text"].append(new_first_line)
-        for line in reversed(lines[1:]):
-            current_window["text"].insert(current_line_index + 1, line)
-            current_line_index += 1
+        if current_line_index >= len(current_window["text"]):
+            current_window["text"].append("")
+        first_line = current_window["text"][current_line_index]
+        current_window["text"][current_line_index] = first_line[:current_column_index] + lines[0] + first_line[current_column_index:]
+        current_window["text"].insert_lines(current_line_index + 1, lines[1:])
         current_window["line_num"] += len(lines) - 1
         current_window["col_num"] = len(lines[-1])
         if current_window["line_num"] >= len(current_window["text"]):
@@ -948,12 +2897,7 @@ class AIQuickKeyEditor:
             self.adjust_window_offset()
     def handle_del_key(self):
         current_window = self.windows[self.context_window]
-        line = current_window["text"][current_window["line_num"]]
-        if current_window["col_num"] < len(line):
-            current_window["text"][current_window["line_num"]] = line[:current_window["col_num"]] + line[current_window["col_num"] + 1:]
-        elif current_window["col_num"] == len(line) and current_window["line_num"] < len(current_window["text"]) - 1:
-            next_line = current_window["text"].pop(current_window["line_num"] + 1)
-            current_window["text"][current_window["line_num"]] += next_line
+        current_window["text"].delete_char(current_window["line_num"], current_window["col_num"])
         self.adjust_window_offset()
     def handle_home_key(self):
         current_window = self.windows[self.context_window]
@@ -993,8 +2937,7 @@ class AIQuickKeyEditor:
     def handle_ctrl_h(self):
         #Below is for debug testing.
         self.status = "Ctrlh"
-        ctxs = self.revision_manager.update_ctx_summary(self.viewpoints)
-        self.display()
+        self.revision_manager.schedule_ctx_summary(0)
     def handle_ctrl_u(self):
         #Below is for debug testing.
         self.status = "Insert text: "
@@ -1017,7 +2960,7 @@ class AIQuickKeyEditor:
                 self.revision_manager.subrev_being_viewed = 0
                 sub_text = self.revision_manager.get_subrevision_text(self.revision_manager.subrev_being_viewed)
             if sub_text:
-                self.windows[0]["text"] = sub_text
+                self.set_window_text(0, sub_text)
                 if self.windows[0]["line_num"] >= len(self.windows[0]["text"]):
                     self.windows[0]["line_num"] = len(self.windows[0]["text"]) - 1
                 if self.windows[0]["line_num"] < 0:
@@ -1034,8 +2977,15 @@ class AIQuickKeyEditor:
             self.status = "bell"
             self.display()
     def handle_sigint(self, sig, frame):
+        # The main thread may be inside the writer's queue or lock right now, so the handler only
+        # notes the Ctrl-C; run() flushes and asks about exiting.
+        self.interrupted = True
+    def confirm_exit(self):
+        self.interrupted = False
+        writer.flush(sync=True)
         self.stdscr.addstr(38, 0, f'Ctrl-C, are you sure you want to exit? (Q/n/W), save your qk edit [{self.revision_manager.original_filename}], beforehand.', curses.A_REVERSE | curses.A_BOLD)
         self.stdscr.refresh()
+        self.renderer.invalidate()
         while True:
             ch = self.stdscr.getch()
             if ch == ord('Q'):
@@ -1050,16 +3000,112 @@ class AIQuickKeyEditor:
         self.status = 'pause'
         self.context_window = 1
         self.display()
+    def read_keys(self):
+        # The first key is waited for, the rest are whatever is already queued behind it, and a
+        # bracketed paste is read through to its end marker, so the whole batch gets one display.
+        keys = [self.stdscr.getch()]
+        if keys[0] == -1:
+            return []
+        self.stdscr.timeout(0)
+        while True:
+            ch = self.stdscr.getch()
+            if ch == -1:
+                if not self.paste_unfinished(keys):
+                    return keys
+                self.stdscr.timeout(self.PASTE_WAIT)
+                ch = self.stdscr.getch()
+                if ch == -1:
+                    return keys
+                self.stdscr.timeout(0)
+            keys.append(ch)
+    def find_marker(self, keys, marker, start):
+        pos = start
+        while True:
+            try:
+                pos = keys.index(27, pos)
+            except ValueError:
+                return -1
+            if keys[pos:pos + len(marker)] == marker:
+                return pos
+            pos += 1
+    def paste_unfinished(self, keys):
+        for size in range(2, len(self.PASTE_START)):
+            if keys[-size:] == self.PASTE_START[:size]:
+                return True
+        start = -1
+        while True:
+            found = self.find_marker(keys, self.PASTE_START, start + 1)
+            if found < 0:
+                break
+            start = found
+        return start >= 0 and self.find_marker(keys, self.PASTE_END, start) < 0
+    def handle_keys(self, keys):
+        # Printable keys in a row go in with one insert_text call; a paste goes in as one block.
+        typed = []
+        pos = 0
+        while pos < len(keys):
+            if keys[pos] == 27 and keys[pos:pos + len(self.PASTE_START)] == self.PASTE_START:
+                self.insert_typed(typed)
+                end = self.find_marker(keys, self.PASTE_END, pos)
+                if end < 0:
+                    end = len(keys)
+                self.insert_paste(keys[pos + len(self.PASTE_START):end])
+                pos = end + len(self.PASTE_END)
+                continue
+            ch = keys[pos]
+            pos += 1
+            if ch not in self.keymap and 32 <= ch < 256 and ch != 127:
+                typed.append(ch)
+                continue
+            self.insert_typed(typed)
+            with self.undo_unit('type' if self.mode == 'edit' and ch in self.typing_keys else 'key'):
+                if ch in self.keymap:
+                    self.keymap[ch]()
+                else:
+                    self.ensure_line()
+                    self.insert_char(ch)
+        self.insert_typed(typed)
+    def ensure_line(self):
+        if self.windows[self.context_window]["line_num"] >= len(self.windows[self.context_window]["text"]):
+            self.windows[self.context_window]["text"].append('')
+    def insert_typed(self, typed):
+        if not typed:
+            return
+        text = ''.join(ch for ch in bytes(typed).decode('utf-8', 'replace') if ch.isprintable())
+        typed.clear()
+        if text:
+            self.ensure_line()
+            current_window = self.windows[self.context_window]
+            self.mode = 'edit'
+            with self.undo_unit('type'):
+                current_window["line_num"], current_window["col_num"] = current_window["text"].insert_text(current_window["line_num"], current_window["col_num"], text)
+            self.adjust_window_offset()
+    def insert_paste(self, keys):
+        text = bytes(ch for ch in keys if ch < 256).decode('utf-8', 'replace')
+        text = ''.join(ch for ch in text.replace('\r\n', '\n').replace('\r', '\n') if ch.isprintable() or ch in '\n\t')
+        if not text:
+            return
+        self.ensure_line()
+        current_window = self.windows[self.context_window]
+        with self.undo_unit('paste'):
+            current_window["line_num"], current_window["col_num"] = current_window["text"].insert_text(current_window["line_num"], current_window["col_num"], text)
+        self.mode = 'line'
+        self.status = 'paste'
+        self.adjust_window_offset()
     def run(self):
         while True:
+            if self.interrupted:
+                self.confirm_exit()
+            self.poll_ai_results()
+            self.poll_writer()
+            self.start_ctx_summary()
+            loading = self.windows[0]["text"].load_more()
             self.display()
-            ch = self.stdscr.getch()
-            if ch in self.keymap:
-                self.keymap[ch]()
-            else:
-                if self.windows[self.context_window]["line_num"] >= len(self.windows[self.context_window]["text"]):
-                    self.windows[self.context_window]["text"].append('')
-                self.insert_char(ch)
+            self.revision_manager.prefetch()
+            self.stdscr.timeout(50 if self.ai_worker.inflight or loading or self.revision_manager.ctx_summary_due is not None else -1)
+            keys = self.read_keys()
+            self.keys_handled += len(keys)
+            self.handle_keys(keys)
     def show_splash_screen(self):
         self.stdscr.clear()
         self.status = 'splsh'
@@ -1079,8 +3125,11 @@ class AIQuickKeyEditor:
             "Ctrl-X: Extract and mark lines (repeat Ctrl-X).",
             "Ctrl-Y: Yank (copy) the marked lines.",
             "Ctrl-P: Paste the yanked lines.",
+            "Ctrl-U: Undo, Ctrl-O: Redo.  Replies, pastes and bursts of typing undo as one.",
             "Ctrl-K: If you need a backslash.",
             "Ctrl-T: Toggle Text through subrevisions.",
+            "Every revision is kept, delta compressed, in <session>.qkrev; --compact tidies it, --rev N writes one out.",
+            "Esc: Cancel the latest AI query still in flight.",
             "Use the arrow keys to navigate.",
             "",
             "Try:",
@@ -1105,11 +3154,145 @@ class AIQuickKeyEditor:
         self.mode = ''
         self.stdscr.refresh()
         self.stdscr.getch()
+        self.renderer.invalidate()
 
 def main(stdscr):
     editor = AIQuickKeyEditor(stdscr)
-    editor.run()
+    sys.stdout.write('\x1b[?2004h')  # Bracketed paste, so a paste arrives marked as one block.
+    sys.stdout.flush()
+    try:
+        editor.run()
+    finally:
+        sys.stdout.write('\x1b[?2004l')
+        sys.stdout.flush()
+
+def compact_session(session):
+    session_name, session_suffix = os.path.splitext(session)
+    bytes_before, bytes_after, replaced = RevisionStore(f'{session_name}.qkrev').compact(session_name, session_suffix)
+    if replaced:
+        print(f"Compacted {session_name}.qkrev: {bytes_before} bytes -> {bytes_after} bytes")
+    else:
+        print(f"{session_name}.qkrev is already compact, {bytes_after} bytes; kept as it was")
+
+def export_revision(session, rev_num, out):
+    revision_manager = EditRevisionManager(session, None)
+    if revision_manager.store.revision_key(rev_num) not in revision_manager.store.index:
+        raise SystemExit(f"No revision {rev_num} in {revision_manager.session_name}.qkrev")
+    out = out or f'{revision_manager.session_name}.{rev_num}{revision_manager.session_suffix}'
+    lines = revision_manager.get_revision(rev_num)
+    with open(out, 'w') as f:
+        f.writelines(line + '\n' for line in lines)
+    print(f"Wrote revision {rev_num} of {session}, {len(lines)} lines, to {out}")
+
+def percentiles(values):
+    values = sorted(values)
+    return values[len(values) // 2], values[min(len(values) - 1, len(values) * 99 // 100)], values[-1]
+
+def bench_save(line_count=200000, saves=3, keys=200, key_interval=0.002):
+    # Keystrokes arrive every key_interval seconds from the moment each save starts; a key's latency
+    # is from its arrival until the UI thread has applied it.  'blocking' waits for the writer after
+    # each save, as the editor did when saves were written on the UI thread.
+    os.chdir(tempfile.mkdtemp(prefix='qk_bench_'))
+    with open('bench.txt', 'w') as f:
+        f.writelines(f"line {i}: the fluffy unicorn, with light green spots\n" for i in range(line_count))
+    viewpoint = SimpleNamespace(get_current_name=lambda: 'Bench')
+    for mode in ('blocking', 'background'):
+        revision_manager = EditRevisionManager('bench.txt', None)
+        buffer = LineBuffer(revision_manager.read_original_lines())
+        command = LineBuffer(["Benchmark the save path."])
+        blocked = []
+        latencies = []
+        for save in range(saves):
+            started = time.perf_counter()
+            revision_manager.write_file(viewpoint, buffer, command)
+            if mode == 'blocking':
+                writer.flush(sync=True)
+            blocked.append(time.perf_counter() - started)
+            for key in range(keys):
+                arrival = started + key * key_interval
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                buffer.insert_text((save * keys + key) * 7919 % line_count, 0, 'x')
+                latencies.append(time.perf_counter() - arrival)
+            writer.flush(sync=True)
+        p50, p99, worst = percentiles(latencies)
+        print(f"{mode:10} {line_count} lines  save blocks the UI {1000 * sum(blocked) / saves:7.1f}ms  "
+              f"keystroke latency p50 {1000 * p50:.2f}ms  p99 {1000 * p99:.2f}ms  max {1000 * worst:.1f}ms")
+        if writer.take_error():
+            print("writer error during the benchmark")
+
+def bench_keys(sizes=(1000, 10000, 100000, 1000000), keys=20000):
+    # Typing and Enter at lines spread through the file; the cost of one key should not grow with
+    # the file.  'list' does the same edits on a plain list of lines, for comparison.
+    for line_count in sizes:
+        lines = [f"line {i}: the fluffy unicorn, with light green spots" for i in range(line_count)]
+        for name, buffer in (('rope', LineBuffer(lines)), ('list', list(lines))):
+            started = time.perf_counter()
+            for key in range(keys):
+                line_num = key * 7919 % len(buffer)
+                if key % 10:
+                    buffer[line_num] = buffer[line_num][:5] + 'x' + buffer[line_num][5:]
+                else:
+                    line = buffer[line_num]
+                    buffer[line_num] = line[:5]
+                    buffer.insert(line_num + 1, line[5:])
+            print(f"{name}  {line_count:8} lines  {1e6 * (time.perf_counter() - started) / keys:7.2f}us per key")
+
+def bench_extract(sizes=(10, 100, 1000), repeats=3):
+    # Replies of size functions, fenced and parsing, and the same with elided bodies, which fall back
+    # to the tokenizer; the time per function should stay flat as the reply grows.
+    cog_engine = CogEngine(None)
+    for size in sizes:
+        parsing = "\n".join(f"def function_{i}(a, b):\n    total = a + b\n    return total * {i}\n" for i in range(size))
+        elided = "\n".join(f"def function_{i}(a, b):\n    ...existing code...\n    return total * {i}\n" for i in range(size))
+        for name, body in (('ast', parsing), ('tokenize', elided)):
+            reply = f"Here are the changes:\n```python\n{body}```\nDone."
+            best = min(timed(cog_engine.extract_objects, reply) for _ in range(repeats))
+            print(f"{name:8} {size:5} functions  {len(reply):8} chars  {1000 * best:8.2f}ms  {1e6 * best / size:6.1f}us per function")
+
+def timed(function, *arguments):
+    started = time.perf_counter()
+    function(*arguments)
+    return time.perf_counter() - started
+
+def bench_refactor(classes=50, methods=20, functions=30, repeats=5):
+    # A file of classes * methods methods, five lines each plus a class header, and a reply
+    # rewriting functions of them spread through the file.
+    text = []
+    for c in range(classes):
+        text += [f"class Widget{c}:"]
+        for m in range(methods):
+            text += [f"    def method_{m}(self, value):", f"        total = value + {m}", "        total *= 2", "        return total", ""]
+    reply = "```python\n" + "\n".join(
+        f"class Widget{i * classes // functions}:\n    def method_{i % methods}(self, value):\n        return value * {i}\n" for i in range(functions)) + "```"
+    cog_engine = CogEngine(None)
+    buffer = LineBuffer(text)
+    editor = SimpleNamespace(
+        windows=[{"text": buffer}],
+        symbol_index=SymbolIndex(buffer),
+        revision_manager=SimpleNamespace(rev_num=1, subrev_num=0),
+        viewpoints=SimpleNamespace(get_current_name=lambda: 'Bench'))
+    objects = cog_engine.extract_objects(reply)
+    editor.symbol_index.keys()
+    for textops in (['Refactor'], ['Markup'], ['Deprecate']):
+        best = min(timed(AIQuickKeyEditor.refactor_edit_window, editor, reply.split('\n'), objects, textops) for _ in range(repeats))
+        result = AIQuickKeyEditor.refactor_edit_window(editor, reply.split('\n'), objects, textops)
+        print(f"{textops[0]:9} {len(text)} lines  {len(objects)} functions  {1000 * best:6.2f}ms  -> {len(result)} lines")
+    started = time.perf_counter()
+    SymbolIndex(buffer).keys()
+    print(f"symbol index built from scratch  {1000 * (time.perf_counter() - started):6.2f}ms")
 
 if __name__ == "__main__":
+    if args.bench:
+        {'save': bench_save, 'keys': bench_keys, 'extract': bench_extract, 'refactor': bench_refactor}[args.bench]()
+        raise SystemExit
+    if args.compact:
+        compact_session(args.session)
+        raise SystemExit
+    if args.rev is not None:
+        export_revision(args.session, args.rev, args.out)
+        raise SystemExit
+    os.environ.setdefault('ESCDELAY', '25')
     curses.wrapper(main)
 
@@ -0,0 +1,102 @@
+# AIStubServer.py
+#  A local, OpenAI compatible, chat completions server, for timing the editors without the network.
+#  Start it, then point an editor at it:
+#      python AIStubServer.py --latency 0.4 --tokens-per-sec 60
+#      OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python AIQuickKeyEditor.py
+#  or let the editor start one of its own with --backend stub:0.4:60 (see AIBackend.py).
+#  --latency is the wait before the first token; --tokens-per-sec paces the rest of the reply.
+#  The reply echoes the last user message, unless --reply names a file to answer with.
+
+import re
+import json
+import time
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--latency', type=float, default=0.25)
+parser.add_argument('--tokens-per-sec', type=float, default=50.0)
+parser.add_argument('--reply', default=None)
+
+class StubCompletions(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        tokens = re.findall(r'\s*\S+', self.server.reply_for(request))
+        if request.get('max_tokens'):
+            tokens = tokens[:request['max_tokens']]
+        time.sleep(self.server.latency)
+        if request.get('stream'):
+            self.stream_reply(request, tokens)
+        else:
+            time.sleep(len(tokens) / self.server.tokens_per_sec)
+            self.send_json(self.completion(request, "".join(tokens), len(tokens)))
+    def completion(self, request, content, completion_tokens):
+        prompt_tokens = sum(len(message.get('content', '').split()) for message in request.get('messages', []))
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'stub'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+    def chunk(self, request, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get('model', 'stub'),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+    def stream_reply(self, request, tokens):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.send_event(self.chunk(request, {"role": "assistant", "content": ""}))
+        for token in tokens:
+            self.send_event(self.chunk(request, {"content": token}))
+            time.sleep(1 / self.server.tokens_per_sec)
+        self.send_event(self.chunk(request, {}, "stop"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+    def send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, port, latency, tokens_per_sec, reply=None):
+        super().__init__(('127.0.0.1', port), StubCompletions)
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.reply = reply
+    def reply_for(self, request):
+        if self.reply is not None:
+            return self.reply
+        user_messages = [message.get('content', '') for message in request.get('messages', []) if message.get('role') == 'user']
+        return user_messages[-1] if user_messages else "I am a fluffy unicorn, with light green spots."
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    reply = None
+    if args.reply:
+        with open(args.reply, 'r') as f:
+            reply = f.read()
+    server = StubServer(args.port, args.latency, args.tokens_per_sec, reply)
+    print(f"AI stub listening on http://127.0.0.1:{args.port}/v1  latency {args.latency}s  {args.tokens_per_sec} tokens/s")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
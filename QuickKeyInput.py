@@ -0,0 +1,149 @@
+# QuickKeyInput.py
+#  Keyboard input for the termios editors: the terminal goes into cbreak mode once, for the life of
+#  the editor, and stdin is read in bulk.  Whatever has already arrived comes back as one batch of keys,
+#  so a paste is one read and one repaint instead of a terminal round trip and a screen clear per character.
+#      with KeyReader() as reader:
+#          for key in reader.read_keys():
+#  A key is one character, or a whole escape sequence such as UP; UTF-8 is decoded across reads.
+#  The paste benchmark runs over a pseudo terminal:
+#      python QuickKeyInput.py --bench 100000
+
+import os
+import sys
+import tty
+import time
+import codecs
+import select
+import termios
+import argparse
+import threading
+
+ESC = '\x1b'
+UP = '\x1b[A'
+DOWN = '\x1b[B'
+RIGHT = '\x1b[C'
+LEFT = '\x1b[D'
+
+class KeyReader:
+    READ_SIZE = 65536
+    ESC_TIMEOUT = 0.05
+
+    def __init__(self, fd=None):
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = ''
+        self.saved = None
+
+    def __enter__(self):
+        if os.isatty(self.fd):
+            self.saved = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+        return self
+
+    def __exit__(self, *exc):
+        if self.saved is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.saved = None
+
+    def ready(self, timeout):
+        return bool(select.select([self.fd], [], [], timeout)[0])
+
+    def read_keys(self):
+        # Blocks for the first byte, then takes everything else already waiting.  An Esc with
+        # nothing after it within ESC_TIMEOUT is the Esc key, not the start of a sequence; a sequence
+        # cut off by the end of a read is held back whole until the rest of it arrives.
+        keys = []
+        while not keys:
+            chunks = [os.read(self.fd, self.READ_SIZE)]
+            if not chunks[0]:
+                raise EOFError
+            while chunks[-1] and self.ready(0):
+                chunks.append(os.read(self.fd, self.READ_SIZE))
+            keys = self.split(self.decoder.decode(b''.join(chunks)))
+            if self.pending == ESC and not self.ready(self.ESC_TIMEOUT):
+                keys.append(ESC)
+                self.pending = ''
+        return keys
+
+    def split(self, text):
+        text = self.pending + text
+        self.pending = ''
+        keys = []
+        pos = 0
+        while pos < len(text):
+            if text[pos] != ESC:
+                end = text.find(ESC, pos)
+                if end < 0:
+                    end = len(text)
+                keys.extend(text[pos:end])
+            else:
+                end = self.sequence_end(text, pos)
+                if end is None:
+                    self.pending = text[pos:]
+                    break
+                keys.append(text[pos:end])
+            pos = end
+        return keys
+
+    @staticmethod
+    def sequence_end(text, pos):
+        # Just past the escape sequence starting at pos, or None when it may go on in the next read.
+        if pos + 1 >= len(text):
+            return None
+        if text[pos + 1] == '[':
+            end = pos + 2
+            while end < len(text) and ' ' <= text[end] <= '?':
+                end += 1
+            return end + 1 if end < len(text) else None
+        if text[pos + 1] == 'O':
+            return pos + 3 if pos + 2 < len(text) else None
+        return pos + 1
+
+def feed(fd, data):
+    # Writes the paste into the terminal, giving up once the reader stops taking it.
+    pos = 0
+    while pos < len(data) and select.select([], [fd], [], 0.5)[1]:
+        pos += os.write(fd, data[pos:pos + 1024])
+
+def bench(size):
+    # The same paste read the old way, a character at a time with the terminal set up and restored around
+    # each read and a repaint per key, then in batches with one repaint per batch.  Setting cbreak mode
+    # flushes typed ahead input, so the old way also loses most of a paste.
+    sample = "The fluffy unicorn — with light green spots — naïvely pasted this.\n" + UP + LEFT
+    paste = (sample * (size // len(sample) + 1))[:size].encode()
+    for name in ('per key', 'batched'):
+        master, slave = os.openpty()
+        os.set_blocking(master, False)
+        tty.setcbreak(slave)
+        feeder = threading.Thread(target=feed, args=(master, paste))
+        started = time.perf_counter()
+        feeder.start()
+        count = 0
+        repaints = 0
+        if name == 'per key':
+            while count < len(paste):
+                old_settings = termios.tcgetattr(slave)
+                try:
+                    tty.setcbreak(slave)
+                    if not select.select([slave], [], [], 0.2)[0]:
+                        break
+                    count += len(os.read(slave, 1))
+                finally:
+                    termios.tcsetattr(slave, termios.TCSADRAIN, old_settings)
+                repaints += 1
+        else:
+            reader = KeyReader(slave)
+            while count < len(paste):
+                count += sum(len(key.encode()) for key in reader.read_keys())
+                repaints += 1
+        elapsed = time.perf_counter() - started
+        feeder.join()
+        os.close(master)
+        os.close(slave)
+        print(f"{name:8} {count} of {len(paste)} bytes in {elapsed:.3f}s  {count / elapsed / 1e6:.2f} MB/s  {repaints} repaints")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=int, default=100000)
+    args = parser.parse_args()
+    bench(args.bench)
@@ -6,18 +6,24 @@
 # You can quickly toggle between the AI’s correction suggestions and your original text by pressing the backspace key, allowing for easy comparison.
 
 import sys
-import tty
-import termios
 import os
+import re
+import zlib
+import hashlib
 import argparse
 import json
 import psutil
-from openai import OpenAI
-client = OpenAI(api_key=os.environ.get("CUSTOM_ENV_NAME"))
+from AIBackend import open_backend, add_backend_argument
+from QuickSpellIndex import SpellIndex
+from QuickKeyInput import KeyReader, UP, DOWN, RIGHT, LEFT
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--file', default='quick.txt')
+parser.add_argument('--words', default=None, help='word list, or its .qksi index, for checking spelling locally first')
+add_backend_argument(parser)
 args = parser.parse_args()
+backend = open_backend(args.backend)
+spell_index = SpellIndex.open(args.words) if args.words else None
 
 class CogQuery:
     def __init__(self, role, content):
@@ -77,6 +83,47 @@ class Cognatlities:
     def add_attribute(self, attribute):
         self.attributes.append(attribute)
 
+class SentenceCache:
+    # Corrections by sentence, keyed by a hash of the sentence, kept in a zlib compressed sidecar
+    # next to the document.  Each correction is also filed under its own text, so a sentence that
+    # has been corrected once is not sent again.
+    MAX_ENTRIES = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, 'rb') as f:
+                self.entries = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error):
+            self.entries = {}
+
+    def key(self, sentence):
+        return hashlib.blake2b(sentence.encode(), digest_size=8).hexdigest()
+
+    def get(self, sentence):
+        key = self.key(sentence)
+        correction = self.entries.pop(key, None)
+        if correction is not None:
+            self.entries[key] = correction
+        return correction
+
+    def put(self, sentence, correction):
+        for key in (self.key(sentence), self.key(correction)):
+            self.entries.pop(key, None)
+            self.entries[key] = correction
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        entries = dict(list(self.entries.items())[-self.MAX_ENTRIES:])
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(zlib.compress(json.dumps(entries, separators=(',', ':')).encode()))
+        os.replace(self.path + '.tmp', self.path)
+        self.dirty = False
+
 class QuickSpellEditor:
     def handle_return(self):
         line = self.text[self.line_num]
@@ -99,6 +146,7 @@ class QuickSpellEditor:
         self.text = []
         self.col_num = 1
         self.oldtext = []
+        self.sentence_cache = SentenceCache(args.file + '.qkspell')
 
         cognatlity = Cognatlities('Spell and Grammer check')
         cognatlity.add_attribute('Your task is to spell and grammer check the following sentences. ')
@@ -111,33 +159,21 @@ class QuickSpellEditor:
         for attribute in chosen_attributes:
             self.context.add_cogtext("system", attribute)
 
-    def read_key(self):
-        fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
-        try:
-            tty.setcbreak(sys.stdin.fileno())
-            ch = sys.stdin.read(1)
-        finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        return ch
-
     def display(self):
         modeOrStatus = self.mode
         if self.status != "":
             modeOrStatus = self.status
             self.status = ""
-        sys.stdout.write('\x1b[2J\x1b[H')  # clear screen
+        screen = ['\x1b[2J\x1b[H']  # clear screen
         for y, line in enumerate(self.text):
-            print(f"\033[7m>{y:03}<{modeOrStatus:5}>\033[0m ", end="")
+            screen.append(f"\033[7m>{y:03}<{modeOrStatus:5}>\033[0m ")
             if y == self.line_num:
-                for x, ch in enumerate(line, start=1):
-                    if x == self.col_num:
-                        print('\033[7m' + ch + '\033[0m', end='')
-                    else:
-                        print(ch, end='')
-                print()
+                col = self.col_num - 1
+                screen.append(line[:col] + '\033[7m' + line[col:col + 1] + '\033[0m' + line[col + 1:] + '\n' if col >= 0 else line + '\n')
             else:
-                print(line)
+                screen.append(line + '\n')
+        sys.stdout.write(''.join(screen))
+        sys.stdout.flush()
 
     def insert_char(self, line_num, col_num, ch):
         self.mode = 'edit'
@@ -188,15 +224,14 @@ class QuickSpellEditor:
         else:
             self.insert_char(self.line_num, self.col_num, ch)
 
-    def handle_backslash(self):
-      # Light green is my favorite color, but the sky is a wonderful hue of blue.
+    def query(self, lines):
         self.context.reset()
         userlines = ""
-        for line in self.text:
+        for line in lines:
             userlines += line + '\n'
         self.context.add_usermsg(userlines)
 
-        completion = client.chat.completions.create(
+        completion = backend.complete(
             model=self.context.get_model(),
             max_tokens=self.context.get_maxtokens(),
             messages=self.context.get_cogtext()
@@ -206,13 +241,64 @@ class QuickSpellEditor:
 
         # Debug, write the context with the AI reply.
         #sys.stdout.write(json.dumps(self.context.get_cogtext(), indent=2))
+        return completion.choices[0].message.content.split('\n')
+
+    def sentence_spans(self, line):
+        return [match.span() for match in re.finditer(r'\S.*?(?:[.!?]+["\')\]]*(?=\s|$)|$)', line)]
+
+    def correct_line(self, line, corrected):
+        pieces = []
+        pos = 0
+        for start, end in self.sentence_spans(line):
+            pieces.append(line[pos:start])
+            pieces.append(corrected.get(line[start:end], line[start:end]))
+            pos = end
+        pieces.append(line[pos:])
+        return ''.join(pieces)
+
+    def handle_backslash(self):
+      # Light green is my favorite color, but the sky is a wonderful hue of blue.
+      # Each sentence is corrected once: from the sentence cache, else from the spelling index when
+      # its only problems are clear typos, and only the sentences left over go to the AI, one per line.
+        corrected = {}
+        pending = []
+        for line in self.text:
+            for start, end in self.sentence_spans(line):
+                sentence = line[start:end]
+                if sentence in corrected or sentence in pending:
+                    continue
+                correction = self.sentence_cache.get(sentence)
+                if correction is None and spell_index is not None:
+                    check = spell_index.check_line(sentence)
+                    if not check.escalate:
+                        correction = check.text
+                        self.sentence_cache.put(sentence, correction)
+                if correction is None:
+                    pending.append(sentence)
+                else:
+                    corrected[sentence] = correction
+        content_lines = None
+        if pending:
+            reply_lines = self.query(pending)
+            while len(reply_lines) > len(pending) and not reply_lines[-1].strip():
+                reply_lines.pop()
+            if len(reply_lines) == len(pending):
+                for sentence, reply_line in zip(pending, reply_lines):
+                    corrected[sentence] = reply_line.strip()
+                    self.sentence_cache.put(sentence, corrected[sentence])
+            else:
+                content_lines = self.query(self.text)
+        else:
+            self.status = "local"
+        if content_lines is None:
+            content_lines = [self.correct_line(line, corrected) for line in self.text]
+        self.sentence_cache.save()
 
         self.oldtext = self.text
         self.text = []
         self.line_num = 0
         self.mode = "reply"
 
-        content_lines = completion.choices[0].message.content.split('\n')
         for cline in content_lines:
             self.text.insert(self.line_num, cline)
             self.line_num += 1
@@ -241,37 +327,36 @@ class QuickSpellEditor:
 
     def run(self):
         self.text.append('')
-        while True:
-            self.display()
-            ch = self.read_key()
-            if ch == '\x03':  # Ctrl-C
-                break
-            elif ch == '\x1b':  # Esc
-                next_ch = self.read_key()
-                if next_ch == '[':  # Bracket
-                    next_ch = self.read_key()
-                    if next_ch == 'A':  # Up arrow
+        with KeyReader() as reader:
+            while True:
+                self.display()
+                for ch in reader.read_keys():  # Everything typed or pasted since the last repaint.
+                    if ch == '\x03':  # Ctrl-C
+                        return
+                    elif ch == UP:  # Up arrow
                         self.handle_up_arrow()
-                    elif next_ch == 'B':  # Down arrow
+                    elif ch == DOWN:  # Down arrow
                         self.handle_down_arrow()
-                    if next_ch == 'C':  # Up arrow
+                    elif ch == RIGHT:  # Right arrow
                         self.handle_right_arrow()
-                    elif next_ch == 'D':  # Down arrow
+                    elif ch == LEFT:  # Left arrow
                         self.handle_left_arrow()
-            elif ch == '\\':  # Backslash
-                self.handle_backslash()
-            elif ch == '\n':  # Return
-                self.handle_return()
-            elif ch == '\x08' or ch == '\x7f':  # Backspace
-                self.handle_backspace(ch)
-            elif ch == '\x17':  # Ctrl-W
-                self.write_file()
-            elif ch == '\x12':  # Ctrl-R
-                self.read_file()
-            else:
-                if self.line_num >= len(self.text):
-                    self.text.append('')
-                self.insert_char(self.line_num, self.col_num, ch)
+                    elif ch.startswith('\x1b'):  # Esc, or a key without a binding
+                        pass
+                    elif ch == '\\':  # Backslash
+                        self.handle_backslash()
+                    elif ch == '\n':  # Return
+                        self.handle_return()
+                    elif ch == '\x08' or ch == '\x7f':  # Backspace
+                        self.handle_backspace(ch)
+                    elif ch == '\x17':  # Ctrl-W
+                        self.write_file()
+                    elif ch == '\x12':  # Ctrl-R
+                        self.read_file()
+                    else:
+                        if self.line_num >= len(self.text):
+                            self.text.append('')
+                        self.insert_char(self.line_num, self.col_num, ch)
 
 if __name__ == '__main__':
     QuickSpellEditor().run()
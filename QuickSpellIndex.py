@@ -0,0 +1,204 @@
+# QuickSpellIndex.py
+#  An offline spelling index for the qk editors, so lines with only obvious typos never wait on the AI.
+#  Build it once from a word list, one word per line, optionally followed by a frequency count:
+#      python QuickSpellIndex.py words.txt                           (writes words.txt.qksi)
+#      python QuickSpellIndex.py words.txt --check QuickSpellEditor.txt
+#  SymSpell style: each word is filed under the crc32 of every string made by deleting up to
+#  max_distance characters from its first prefix_length characters.  The hashes sit in one sorted
+#  array that is mmapped on load, so opening the index costs no parsing.  A misspelling finds its
+#  candidates by looking up its own deletes; the true edit distance then picks the fix.
+
+import os
+import re
+import mmap
+import time
+import zlib
+import bisect
+import struct
+import argparse
+from array import array
+from types import SimpleNamespace
+
+class SpellIndex:
+    MAGIC = b'QKSI1\n'
+    HEADER = struct.Struct('<6sIIIII')
+    MAX_DISTANCE = 2
+    PREFIX_LENGTH = 7
+    word_pattern = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+    url_pattern = re.compile(r"\S+://\S+|www\.\S+")
+    suffixes = ("s", "es", "ed", "d", "ing", "ly", "er", "est")
+    MIN_FIX_LENGTH = 4
+    doubled_pattern = re.compile(r"\b(\w+)\s+\1\b", re.IGNORECASE)
+    grammar_patterns = [
+        doubled_pattern,
+        re.compile(r"\bi\b"),
+        re.compile(r"[.!?]\s+[a-z]"),
+        re.compile(r"\s[,.;:!?]"),
+        re.compile(r"[,;:](?=[^\W\d_])")
+    ]
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.max_distance, self.prefix_length, word_count, entry_count, words_size = self.HEADER.unpack_from(self.mm)
+        if magic != self.MAGIC:
+            raise ValueError(f"{index_path} is not a spelling index")
+        offset = self.HEADER.size
+        self.words = self.mm[offset:offset + words_size].decode().split('\n')
+        offset += words_size + (-words_size % 4)
+        view = memoryview(self.mm)
+        self.counts = view[offset:offset + 4 * word_count].cast('I')
+        offset += 4 * word_count
+        self.hashes = view[offset:offset + 4 * entry_count].cast('I')
+        offset += 4 * entry_count
+        self.ids = view[offset:offset + 4 * entry_count].cast('I')
+        self.lines_checked = 0
+        self.lines_escalated = 0
+        self.check_seconds = 0.0
+    @classmethod
+    def open(cls, path):
+        # Accepts an index, or a word list whose index is built next to it when missing or older.
+        if path.endswith('.qksi'):
+            return cls(path)
+        index_path = path + '.qksi'
+        try:
+            stale = os.path.getmtime(index_path) < os.path.getmtime(path)
+        except OSError:
+            stale = True
+        if stale:
+            cls.build(path, index_path)
+        return cls(index_path)
+    @classmethod
+    def build(cls, words_path, index_path, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH):
+        counts = {}
+        with open(words_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    word = fields[0].lower()
+                    counts[word] = counts.get(word, 0) + (int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 1)
+        words = sorted(counts)
+        entries = array('Q', sorted(
+            zlib.crc32(delete.encode()) << 32 | word_id
+            for word_id, word in enumerate(words)
+            for delete in cls.deletes(word[:prefix_length], max_distance)
+        ))
+        words_blob = '\n'.join(words).encode()
+        with open(index_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, max_distance, prefix_length, len(words), len(entries), len(words_blob)))
+            f.write(words_blob + b'\0' * (-len(words_blob) % 4))
+            f.write(array('I', (min(counts[word], 0xFFFFFFFF) for word in words)).tobytes())
+            f.write(array('I', (entry >> 32 for entry in entries)).tobytes())
+            f.write(array('I', (entry & 0xFFFFFFFF for entry in entries)).tobytes())
+    @staticmethod
+    def deletes(word, max_distance):
+        found = {word}
+        edge = {word}
+        for _ in range(max_distance):
+            edge = {term[:i] + term[i + 1:] for term in edge for i in range(len(term))} - found
+            found |= edge
+        return found
+    @staticmethod
+    def distance(a, b, limit):
+        # Optimal string alignment distance, given up once every cell of a row is over limit.
+        if abs(len(a) - len(b)) > limit:
+            return limit + 1
+        previous = None
+        row = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            before, previous, row = previous, row, [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                cost = a[i - 1] != b[j - 1]
+                row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+                if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    row[j] = min(row[j], before[j - 2] + 1)
+            if min(row) > limit:
+                return limit + 1
+        return row[-1]
+    def word_ids(self, term):
+        key = zlib.crc32(term.encode())
+        i = bisect.bisect_left(self.hashes, key)
+        while i < len(self.hashes) and self.hashes[i] == key:
+            yield self.ids[i]
+            i += 1
+    def known(self, word):
+        return any(self.words[word_id] == word for word_id in self.word_ids(word[:self.prefix_length]))
+    def candidates(self, word):
+        found = {}
+        for delete in self.deletes(word[:self.prefix_length], self.max_distance):
+            for word_id in self.word_ids(delete):
+                if word_id not in found:
+                    found[word_id] = self.distance(word, self.words[word_id], self.max_distance)
+        return sorted((distance, -self.counts[word_id], self.words[word_id]) for word_id, distance in found.items() if distance <= self.max_distance)
+    def known_form(self, word):
+        stem = re.split(r"['’]", word)[0]
+        return self.known(stem) or any(stem.endswith(suffix) and self.known(stem[:-len(suffix)]) for suffix in self.suffixes)
+    def check_word(self, token):
+        # The token itself when it is spelled right or is a plain inflection of a known word, its
+        # fix when there is one clear candidate one edit away (or one ten times as common as the
+        # next), otherwise None.  Short words are too ambiguous to fix without the sentence.
+        word = token.lower()
+        if self.known_form(word):
+            return token
+        if len(word) < self.MIN_FIX_LENGTH:
+            return None
+        candidates = self.candidates(word)
+        if not candidates or candidates[0][0] != 1:
+            return None
+        if len(candidates) > 1 and candidates[1][0] == 1 and -candidates[0][1] < 10 * -candidates[1][1]:
+            return None
+        fix = candidates[0][2]
+        if token.isupper():
+            return fix.upper()
+        if token[0].isupper():
+            return fix[0].upper() + fix[1:]
+        return fix
+    def check_line(self, line):
+        started = time.perf_counter()
+        pieces = []
+        fixes = []
+        unresolved = []
+        pos = 0
+        urls = [match.span() for match in self.url_pattern.finditer(line)]
+        for match in self.word_pattern.finditer(line):
+            token = match.group()
+            if any(start <= match.start() < end for start, end in urls):
+                continue
+            if len(token) == 1 or token.isupper() or any(ch.isupper() for ch in token[1:]):
+                continue
+            fix = self.check_word(token)
+            if fix is None:
+                unresolved.append(token)
+            elif fix != token:
+                pieces.append(line[pos:match.start()])
+                pieces.append(fix)
+                pos = match.end()
+                fixes.append((token, fix))
+        pieces.append(line[pos:])
+        text = ''.join(pieces)
+        grammar = [pattern.pattern for pattern in self.grammar_patterns if pattern.search(text)]
+        escalate = bool(unresolved or grammar)
+        self.lines_checked += 1
+        self.lines_escalated += escalate
+        self.check_seconds += time.perf_counter() - started
+        return SimpleNamespace(text=text, fixes=fixes, unresolved=unresolved, grammar=grammar, escalate=escalate)
+    def describe(self):
+        if not self.lines_checked:
+            return "spell idle"
+        local = 100 * (self.lines_checked - self.lines_escalated) // self.lines_checked
+        return f"spell {local}% local {1000 * self.check_seconds / self.lines_checked:.2f}ms/line"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('words')
+    parser.add_argument('--check', default=None)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    index = SpellIndex.open(args.words)
+    print(f"{len(index.words)} words, {len(index.hashes)} deletes, opened in {1000 * (time.perf_counter() - started):.1f}ms")
+    if args.check:
+        with open(args.check, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, start=1):
+                check = index.check_line(line.rstrip('\n'))
+                if check.fixes or check.escalate:
+                    print(f"{line_num:4}: fixed {check.fixes}  unresolved {check.unresolved}  grammar {len(check.grammar)}")
+        print(index.describe())
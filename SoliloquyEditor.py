@@ -6,14 +6,17 @@
 #    pressing enter, the AI will elaborate and provide more information.
 
 import sys
-import tty
-import termios
 import os
 import json
+import argparse
 import psutil
-from openai import OpenAI
+from AIBackend import open_backend, add_backend_argument
+from QuickKeyInput import KeyReader, ESC
 
-client = OpenAI(api_key=os.environ.get("CUSTOM_ENV_NAME"))
+parser = argparse.ArgumentParser()
+add_backend_argument(parser)
+args = parser.parse_args()
+backend = open_backend(args.backend)
 
 class Message:
     def __init__(self, role, content):
@@ -82,7 +85,7 @@ class SoliloquyEditor:
         # Debug, write the message going to openAI to the screen.
         sys.stdout.write(json.dumps(self.context.get_messages(), indent=2))
 
-        completion = client.chat.completions.create(
+        completion = backend.complete(
             model=self.context.get_model(),
             max_tokens=self.context.get_max_tokens(),
             messages=self.context.get_messages()
@@ -154,16 +157,6 @@ class SoliloquyEditor:
         choice = int(input(prompt))
         return self.personalities[personality_names[choice - 1]]
 
-    def read_key(self):
-        fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
-        try:
-            tty.setcbreak(sys.stdin.fileno())
-            ch = sys.stdin.read(1)
-        finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        return ch
-
     def display(self):
         sys.stdout.write('\x1b[2J\x1b[H')  # clear screen
         for x, line in enumerate(self.text):
@@ -181,17 +174,20 @@ class SoliloquyEditor:
             self.col_num += 1
 
     def run(self):
-        while True:
-            self.display()
-            ch = self.read_key()
-            if ch == '\x1b':  # esc
-                break
-            elif ch == '\n':
-                self.handle_return()
-            else:
-                if self.line_num >= len(self.text):
-                    self.text.append('')
-                self.insert_char(self.line_num, self.col_num, ch)
+        with KeyReader() as reader:
+            while True:
+                self.display()
+                for ch in reader.read_keys():  # Everything typed or pasted since the last repaint.
+                    if ch == ESC:  # esc
+                        return
+                    elif ch.startswith(ESC):  # Arrows and other keys without a binding
+                        pass
+                    elif ch == '\n':
+                        self.handle_return()
+                    else:
+                        if self.line_num >= len(self.text):
+                            self.text.append('')
+                        self.insert_char(self.line_num, self.col_num, ch)
 
 if __name__ == '__main__':
     SoliloquyEditor().run()
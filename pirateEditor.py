@@ -9,13 +9,15 @@
 #  and to provide a larger context than what is available to me. 
 
 import sys
-import tty
-import termios
-import os
 import json
-from openai import OpenAI
+import argparse
+from AIBackend import open_backend, add_backend_argument
+from QuickKeyInput import KeyReader, ESC
 
-client = OpenAI(api_key=os.environ.get("CUSTOM_ENV_NAME"))
+parser = argparse.ArgumentParser()
+add_backend_argument(parser)
+args = parser.parse_args()
+backend = open_backend(args.backend)
 
 class Editor:
     line_num = 0
@@ -56,7 +58,7 @@ class Editor:
 
         sys.stdout.write(json.dumps(msgs, indent=4)) 
 
-        completion = client.chat.completions.create(
+        completion = backend.complete(
           #model="gpt-3.5-turbo",
           model="gpt-4o",
           max_tokens=3333,
@@ -71,16 +73,6 @@ class Editor:
     def __init__(self):
         self.text = []
 
-    def read_key(self):
-        fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
-        try:
-            tty.setcbreak(sys.stdin.fileno())
-            ch = sys.stdin.read(1)
-        finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        return ch
-
     def display(self):
         sys.stdout.write('\x1b[2J\x1b[H')  # clear screen
         for line in self.text:
@@ -98,17 +90,20 @@ class Editor:
             self.col_num += 1
 
     def run(self):
-        while True:
-            self.display()
-            ch = self.read_key()
-            if ch == '\x1b':  # ESC
-                break
-            elif ch == '\n':
-                self.handle_return()
-            else:
-                if self.line_num >= len(self.text):
-                    self.text.append('')
-                self.insert_char(self.line_num, self.col_num, ch)
+        with KeyReader() as reader:
+            while True:
+                self.display()
+                for ch in reader.read_keys():  # Everything typed or pasted since the last repaint.
+                    if ch == ESC:  # ESC
+                        return
+                    elif ch.startswith(ESC):  # Arrows and other keys without a binding
+                        pass
+                    elif ch == '\n':
+                        self.handle_return()
+                    else:
+                        if self.line_num >= len(self.text):
+                            self.text.append('')
+                        self.insert_char(self.line_num, self.col_num, ch)
 
 if __name__ == '__main__':
     Editor().run()